@@ -0,0 +1,714 @@
+import argparse
+import contextlib
+import io
+import ipaddress
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pprint import pprint
+
+from tfdb import TerraformState, state_file_rows
+from tfflat import flatten_attributes, resource_row
+from tfquery import loop_queries
+
+
+def synthetic_resource(rtype, i, extra_attributes=0):
+    id = f"{rtype}-{i:08x}"
+    attributes = {
+        "id": id,
+        "arn": f"arn:aws:ec2:ap-southeast-2:012345678901:{rtype}/{id}",
+        "private_ip": f"10.{i % 256}.{(i // 256) % 256}.{i % 250 + 1}",
+        "subnet_id": f"subnet-{i % 64:08x}",
+        "cpu_core_count": str(1 << (i % 4)),
+        "ebs_optimized": "true" if i % 3 else "false",
+        "tags.%": "2",
+        "tags.Name": f"{rtype}-{i}",
+        "tags.Env": random.choice(["prod", "dev", "test"]),
+        "ebs_block_device.#": "1",
+        "ebs_block_device.0.device_name": "/dev/sdb",
+        "ebs_block_device.0.volume_size": str(random.randint(8, 500)),
+    }
+    if extra_attributes > 0:
+        attributes["security_groups.#"] = str(extra_attributes)
+        for n in range(0, extra_attributes):
+            attributes[f"security_groups.{n}"] = f"sg-{n:08x}"
+    return {
+        "type": rtype,
+        "primary": {"id": id, "attributes": attributes},
+        "provider": "provider.aws",
+    }
+
+
+def synthetic_state(resources):
+    return {
+        "version": 3,
+        "terraform_version": "0.12.31",
+        "serial": 1,
+        "lineage": "",
+        "modules": [
+            {
+                "path": ["root"],
+                "outputs": {},
+                "resources": {
+                    f"{r['type']}.tfer--{r['primary']['id']}": r for r in resources
+                },
+                "depends_on": [],
+            }
+        ],
+    }
+
+
+def synthetic_state_files(files, resources_per_file, extra_attributes=0):
+    random.seed(files * resources_per_file)
+    rtypes = ["aws_instance", "aws_subnet", "aws_network_interface", "aws_eip"]
+    state_files = []
+    for f in range(0, files):
+        resources = [
+            synthetic_resource(
+                rtypes[f % len(rtypes)],
+                random.randint(0, files * resources_per_file // 2),
+                extra_attributes,
+            )
+            for _ in range(0, resources_per_file)
+        ]
+        state_files.append(json.dumps(synthetic_state(resources)))
+    return state_files
+
+
+def bench_ingest(args):
+    state_files = synthetic_state_files(args.files, args.resources)
+    rows = args.files * args.resources
+    for name, bulk in [("per-row commit", False), ("bulk", True)]:
+        tfs = TerraformState(bulk=bulk)
+        start = time.time()
+        with tfs.bulk():
+            for state_file in state_files:
+                tfs.add_state_file(io.StringIO(state_file))
+        how_long = time.time() - start
+        pprint((name, rows, "rows in", how_long, rows / how_long))
+    if args.jobs > 1:
+        with tempfile.TemporaryDirectory() as tmp:
+            state_file_names = []
+            for idx, state_file in enumerate(state_files):
+                state_file_names.append(os.path.join(tmp, f"{idx}.tfstate"))
+                with open(state_file_names[-1], "w") as f:
+                    f.write(state_file)
+            tfs = TerraformState()
+            start = time.time()
+            tfs.add_state_files(state_file_names, jobs=args.jobs)
+            how_long = time.time() - start
+            pprint(
+                (f"bulk, {args.jobs} jobs", rows, "rows in", how_long, rows / how_long)
+            )
+
+
+def bench_stream(args):
+    random.seed(0)
+    resources = [
+        synthetic_resource("aws_security_group", i, args.attributes)
+        for i in range(0, args.resources)
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file_name = os.path.join(tmp, "terraform.tfstate")
+        with open(state_file_name, "w") as f:
+            json.dump(synthetic_state(resources), f)
+        del resources
+
+        def whole_file(state_file):
+            tfstate = json.load(state_file)
+            for resource in tfstate["modules"][0]["resources"].values():
+                yield resource["type"], resource_row(resource["primary"]["attributes"])
+
+        for name, fn in [("json.load", whole_file), ("streaming", state_file_rows)]:
+            tracemalloc.start()
+            start = time.time()
+            with open(state_file_name, "r") as state_file:
+                for rtype, r in fn(state_file):
+                    pass
+            how_long = time.time() - start
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            pprint(
+                (
+                    name,
+                    os.path.getsize(state_file_name),
+                    "bytes",
+                    peak,
+                    "peak",
+                    how_long,
+                )
+            )
+
+
+def synthetic_tables(tables, rows):
+    # a CMDB style export: {table: [row, ...]}, a few columns only some rows have
+    random.seed(0)
+    d_of_t = dict()
+    for t in range(0, tables):
+        t_rows = []
+        for i in range(0, rows):
+            row = {
+                "name": f"host-{t}-{i}",
+                "owner": random.choice(["ops", "dev", "data", "security"]),
+                "cpus": random.choice([1, 2, 4, 8]),
+                "memory_gb": random.choice([0.5, 1.0, 4.0, 16.0]),
+                "in_service": random.random() > 0.1,
+                "ip": f"10.{t}.{i // 256 % 256}.{i % 256}",
+                "location": random.choice(["syd", "sin", "mel"]),
+            }
+            if i % 10 == 0:
+                row["decommission_date"] = "2025-01-01"
+            t_rows.append(row)
+        d_of_t[f"cmdb_{t}"] = t_rows
+    return d_of_t
+
+
+def bench_tables(args):
+    import yaml
+
+    d_of_t = synthetic_tables(args.tables, args.rows)
+    rows = args.tables * args.rows
+
+    def whole_file(load, bulk):
+        def add(tfs, filename):
+            with open(filename, "r") as f:
+                d_of_t = load(f)
+            if bulk:
+                tfs.add_dict_of_tables(d_of_t)
+            else:
+                # as it was: every row inserted on its own
+                for t_name, t_rows in d_of_t.items():
+                    for r in t_rows:
+                        tfs._add(t_name, r)
+
+        return add
+
+    loaders = {
+        "json": [
+            ("json.load, per-row", whole_file(json.load, False)),
+            ("json.load, bulk", whole_file(json.load, True)),
+            ("streaming", TerraformState.add_json_file),
+        ],
+        "yaml": [
+            ("yaml.safe_load, per-row", whole_file(yaml.safe_load, False)),
+            ("yaml.safe_load, bulk", whole_file(yaml.safe_load, True)),
+            (
+                "streaming, libyaml" if yaml.__with_libyaml__ else "streaming",
+                TerraformState.add_yaml_file,
+            ),
+        ],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind, kind_loaders in loaders.items():
+            filename = os.path.join(tmp, f"cmdb.{kind}")
+            with open(filename, "w") as f:
+                if kind == "json":
+                    json.dump(d_of_t, f)
+                else:
+                    yaml.safe_dump(d_of_t, f)
+            for name, add in kind_loaders:
+                tfs = TerraformState(bulk="per-row" not in name, auto_index=False)
+                if args.memory:
+                    tracemalloc.start()
+                start = time.time()
+                with tfs.bulk():
+                    add(tfs, filename)
+                how_long = time.time() - start
+                result = (kind, name, rows, "rows in", how_long, rows / how_long)
+                if args.memory:
+                    result += (tracemalloc.get_traced_memory()[1], "peak")
+                    tracemalloc.stop()
+                pprint(result)
+
+
+def bench_types(args):
+    # declared column types against the all-text tables of earlier versions;
+    # on text "cpu_core_count > 2" compares a string with a number (always
+    # true) and "where ebs_optimized" reads 'true' as 0
+    state_files = synthetic_state_files(args.files, args.resources)
+    queries = {
+        "numeric predicate": "select count(*) from aws_instance where cpu_core_count > 2",
+        "aggregate": "select sum(cpu_core_count), avg(cpu_core_count) from aws_instance",
+        "boolean": "select count(*) from aws_instance where ebs_optimized",
+    }
+    for name, typed in [("text", False), ("typed", True)]:
+        tfs = TerraformState(typed=typed, auto_index=False, cidr_index=False)
+        with tfs.bulk():
+            for state_file in state_files:
+                tfs.add_state_file(io.StringIO(state_file))
+        size = tfs.db.execute("pragma page_count;").fetchone()[0]
+        size *= tfs.db.execute("pragma page_size;").fetchone()[0]
+        pprint((name, size, "bytes"))
+        for query_name, sql in queries.items():
+            start = time.time()
+            for _ in range(0, args.repeat):
+                result = tfs.db.execute(sql).fetchall()
+            how_long = time.time() - start
+            pprint((name, query_name, result, args.repeat / how_long, "queries/sec"))
+
+
+def legacy_loop(db, query_table, data_table):
+    # .loop as it was: every query executed once per data row
+    cur = db.cursor()
+    cur.execute(f"select * from {query_table}")
+    colmap = {i[0]: idx for idx, i in enumerate(cur.description)}
+    queries = [{k: row[idx] for k, idx in colmap.items()} for row in cur.fetchall()]
+    cur.execute(f"select * from {data_table}")
+    colmap = {i[0]: idx for idx, i in enumerate(cur.description)}
+    for row_ in cur.fetchall():
+        row = {k: row_[idx] for k, idx in colmap.items()}
+        rowout = []
+        for q in queries:
+            params = []
+            for p in range(0, 10):
+                p_k = f"p{p}"
+                if p_k in q and q[p_k] is not None:
+                    params.append(row[q[p_k]])
+            result = db.execute(q["q"], params).fetchone()
+            if result is not None:
+                result = result[0]
+            rowout.append(str(result))
+        print(",".join(rowout))
+
+
+def bench_loop(args):
+    state_files = synthetic_state_files(4, args.resources)
+    tfs = TerraformState()
+    with tfs.bulk():
+        for state_file in state_files:
+            tfs.add_state_file(io.StringIO(state_file))
+    templates = [
+        ("select count(*) from aws_subnet where subnet_id = ?", "subnet_id"),
+        ("select max(private_ip) from aws_subnet where subnet_id = ?", "subnet_id"),
+        ("select count(*) from aws_eip where private_ip = ?", "private_ip"),
+        ("select arn_field(?, 3)", "arn"),
+        ("select id from aws_network_interface where id > ? limit 1", "id"),
+    ]
+    tfs.add_dict_of_tables(
+        {
+            "queries": [
+                {"q": q, "p0": p0}
+                for q, p0 in (templates * args.queries)[: args.queries]
+            ]
+        }
+    )
+    (rows,) = tfs.db.execute("select count(*) from aws_instance;").fetchone()
+    for name, fn in [
+        ("per row", legacy_loop),
+        ("set based", lambda *a: loop_queries(*a, {"out=" + os.devnull})),
+    ]:
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn(tfs.db, "queries", "aws_instance")
+        how_long = time.time() - start
+        pprint((name, args.queries, "queries", rows, "rows in", how_long))
+
+
+def bench_startup(args):
+    # cold start of tf-explorer for one trivial query against a snapshot
+    # that's already up to date, as wrapper scripts run it
+    state_files = synthetic_state_files(args.files, args.resources)
+    explorer = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "tf-explorer.py"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file_names = []
+        for idx, state_file in enumerate(state_files):
+            state_file_names.append(os.path.join(tmp, f"{idx}.tfstate"))
+            with open(state_file_names[-1], "w") as f:
+                f.write(state_file)
+        snapshot = os.path.join(tmp, "tf.snapshot")
+        command = [sys.executable, explorer, "--snapshot", snapshot]
+        command += state_file_names
+        subprocess.run(command + ["-c", "select 1"], capture_output=True, check=True)
+        runs = [
+            ("python", [sys.executable, "-c", "pass"]),
+            ("table", command + ["-c", "select count(*) from aws_instance"]),
+            ("csv", command + ["-c", "#csv select count(*) from aws_instance"]),
+        ]
+        for name, run in runs:
+            times = []
+            for _ in range(0, args.repeat):
+                start = time.time()
+                subprocess.run(run, capture_output=True, check=True)
+                times.append(time.time() - start)
+            pprint((name, min(times), "min", statistics.median(times), "median"))
+
+
+FLOW_LOG_HEADER = (
+    "version account-id interface-id srcaddr dstaddr srcport dstport protocol "
+    "packets bytes start end action log-status"
+)
+CUSTOM_FLOW_LOG_HEADER = "srcaddr dstaddr bytes protocol account-id action"
+
+
+def synthetic_flow_log(filename, lines, header=FLOW_LOG_HEADER, seed=0):
+    # a gzipped VPC flow log, with NODATA records, ICMP and IPv6 among them
+    import gzip
+
+    random.seed(seed)
+    # each interface has an address and talks to a few of the peers
+    peers = [f"10.{i // 250}.{i % 250}.{i % 7 + 1}" for i in range(0, 2000)]
+    peers += [f"172.31.{i}.10" for i in range(0, 200)] + ["2001:db8::1"]
+    interfaces = [
+        (f"eni-{i:017x}", f"10.100.{i // 250}.{i % 250}", random.sample(peers, 20))
+        for i in range(0, 500)
+    ]
+    with gzip.open(filename, mode="wt", compresslevel=1) as f:
+        f.write(header + "\n")
+        for i in range(0, lines):
+            interface, address, interface_peers = random.choice(interfaces)
+            src, dst = address, random.choice(interface_peers)
+            if random.random() < 0.5:
+                src, dst = dst, src
+            record = {
+                "version": "2",
+                "account-id": f"12345678901{i % 3}",
+                "interface-id": interface,
+                "srcaddr": src,
+                "dstaddr": dst,
+                "srcport": str(random.randrange(0, 65536)),
+                "dstport": random.choice(["443", "80", "22", "5432"]),
+                "protocol": random.choice(["6", "6", "6", "17", "1"]),
+                "packets": str(random.randrange(1, 100)),
+                "bytes": str(random.randrange(40, 100000)),
+                "start": "1600000000",
+                "end": "1600000060",
+                "action": "ACCEPT",
+                "log-status": "OK",
+            }
+            if i % 100 == 0:
+                record.update(
+                    {k: "-" for k in record if k not in ("version", "account-id")}
+                )
+                record.update({"interface-id": "eni-0", "log-status": "NODATA"})
+            f.write(" ".join(record[k] for k in header.split(" ")) + "\n")
+
+
+def legacy_flow_log(logfile):
+    # flowparse.process_single_log as it was: a python dict updated per line
+    import gzip
+
+    tuple_dict = {}
+    rows = 0
+    with gzip.open(logfile, mode="rt") as f:
+        headings = {}
+        for idx, x in enumerate(f.readline().rstrip().split(" ")):
+            headings[x] = idx
+        interface_col = headings.get("interface-id", -1)
+        account_col = headings["account-id"]
+        src_col = headings["srcaddr"]
+        dst_col = headings["dstaddr"]
+        bytes_col = headings["bytes"]
+        protocol_col = headings["protocol"]
+        for line in f:
+            row = line.rstrip().split(" ")
+            rows += 1
+            src = row[src_col]
+            if src == "-":
+                continue
+            protocol = row[protocol_col]
+            if protocol == "1":  # skip ICMP
+                continue
+            dst = row[dst_col]
+            key = "%s %s %s %s" % (
+                row[account_col],
+                row[interface_col] if interface_col != -1 else "0",
+                src,
+                dst,
+            )
+            bytes = int(row[bytes_col])
+            if key in tuple_dict:
+                tuple_dict[key] += bytes
+            else:
+                tuple_dict[key] = bytes
+    return tuple_dict, rows
+
+
+def bench_flowlog(args):
+    from flowlog import read_flow_log
+
+    def vectorized(logfile):
+        table = read_flow_log(logfile)
+        return table.key_bytes(), table.rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for format_name, header in [
+            ("default format", FLOW_LOG_HEADER),
+            ("custom format", CUSTOM_FLOW_LOG_HEADER),
+        ]:
+            logfile = os.path.join(tmp, "flow.log.gz")
+            synthetic_flow_log(logfile, args.lines, header)
+            results = []
+            for name, parse in [("per-line", legacy_flow_log), ("numpy", vectorized)]:
+                start = time.time()
+                results.append(parse(logfile))
+                how_long = time.time() - start
+                lines = results[-1][1]
+                pprint(
+                    (format_name, name, lines, "lines in", how_long, lines / how_long)
+                )
+            assert results[0] == results[1]
+
+
+def bench_flowcache(args):
+    # reloading and merging a folder's per-file caches, as a fully cached
+    # flowparse run does: gzipped pickles of dicts against the columnar files
+    import gzip
+    import pickle
+    from flowlog import merge_tables, read_cache, read_flow_log, write_cache
+
+    def pickle_merge(cache_files):
+        combined = {}
+        for cache_file in cache_files:
+            with gzip.open(cache_file, mode="rb") as f:
+                tuple_dict, rows = pickle.load(f)
+            for k, v in tuple_dict.items():
+                if k not in combined:
+                    combined[k] = v
+                else:
+                    combined[k] += v
+        return combined
+
+    def columnar_merge(cache_files):
+        return merge_tables([read_cache(cache_file) for cache_file in cache_files])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logfile = os.path.join(tmp, "flow.log.gz")
+        caches = {"pickle": [], "columnar": []}
+        for idx in range(0, args.files):
+            synthetic_flow_log(logfile, args.lines, seed=idx)
+            table = read_flow_log(logfile)
+            caches["pickle"].append(os.path.join(tmp, f"{idx}.pickle"))
+            with gzip.open(caches["pickle"][-1], mode="wb") as f:
+                pickle.dump((table.key_bytes(), table.rows), f)
+            caches["columnar"].append(os.path.join(tmp, f"{idx}.columnar"))
+            write_cache(caches["columnar"][-1], table)
+        for name, merge in [("pickle", pickle_merge), ("columnar", columnar_merge)]:
+            size = sum(map(os.path.getsize, caches[name]))
+            start = time.time()
+            merged = merge(caches[name])
+            how_long = time.time() - start
+            pprint((name, args.files, "files", size, "bytes", len(merged), how_long))
+
+
+def legacy_ip_within_sql(needle, haystack):
+    if needle is None or haystack is None:
+        return False
+    needle = ipaddress.ip_address(needle)
+    if "-" in haystack:
+        r0, r1 = map(ipaddress.ip_address, haystack.split("-"))
+        return needle >= r0 and needle <= r1
+    elif "/" in haystack:
+        haystack = ipaddress.ip_network(haystack)
+        return needle in haystack
+    else:
+        raise Exception(f"cannot parse network {haystack}")
+
+
+def legacy_ip_sortable_sql(ip_range_s):
+    if ip_range_s is None:
+        return False
+    ip_address = None
+    if "/" in ip_range_s:
+        ip_range = ipaddress.ip_network(ip_range_s)
+        ip_address = ip_range.network_address
+    else:
+        ip_address = ipaddress.ip_address(ip_range_s)
+
+    return "{:#x}".format(ip_address)
+
+
+def legacy_ip_truncate_sql(addr_as_text, bits):
+    addr = ipaddress.ip_address(addr_as_text)
+    addr_b = bytearray(addr.packed)
+    assert bits % 8 == 0
+    if bits <= 24:
+        addr_b[3] = 0
+    if bits <= 16:
+        addr_b[2] = 0
+    if bits <= 8:
+        addr_b[1] = 0
+    return str(ipaddress.ip_address(bytes(addr_b)))
+
+
+def bench_udf(args):
+    # the same queries against the per-call ipaddress UDFs and the cached,
+    # integer based ones TerraformState registers
+    queries = {
+        "ip_within": "select count(*) from ips where ip_within(ip, '10.0.0.0/10')",
+        "ip_sortable": "select count(distinct ip_sortable(ip)) from ips",
+        "ip_truncate": "select count(distinct ip_truncate(ip, 24)) from ips",
+    }
+    legacy = {
+        "ip_within": (2, legacy_ip_within_sql),
+        "ip_sortable": (1, legacy_ip_sortable_sql),
+        "ip_truncate": (2, legacy_ip_truncate_sql),
+    }
+    for name in ["legacy", "cached"]:
+        if name == "legacy":
+            db = sqlite3.connect(":memory:")
+            for fn_name, (nargs, fn) in legacy.items():
+                db.create_function(fn_name, nargs, fn)
+        else:
+            db = TerraformState().db
+        # flow logs see the same addresses over and over
+        db.execute(f"""create table ips as with recursive n(i) as
+            (select 0 union all select i + 1 from n where i < {args.calls - 1})
+            select printf('10.%d.%d.%d', abs(random()) % 128, abs(random()) % 16,
+            abs(random()) % {args.hosts}) as ip from n""")
+        for fn_name, sql in queries.items():
+            start = time.time()
+            result = db.execute(sql).fetchone()[0]
+            how_long = time.time() - start
+            pprint((name, fn_name, result, args.calls / how_long, "calls/sec"))
+
+
+def legacy_flatten_attributes(attributes):
+    # the Pointer tree flattening state_file_rows used before tfflat
+    class Pointer:
+        def __init__(self, p=None):
+            self.p = p
+
+    ra = dict(attributes)
+    arrays = Pointer({})
+    for k in list(sorted(ra.keys())):  # '#' < '0'
+        v = ra[k]
+        by_dots = k.split(".")
+        if len(by_dots) == 1:
+            continue
+        del ra[k]  # remove arrays
+        arr_host = arrays
+        while len(by_dots) > 0:
+            x = by_dots.pop(0)
+            remaining = len(by_dots)
+            if x == "#":
+                assert arr_host.p is None
+                assert remaining == 0
+                arr_host.p = [Pointer() for i in range(0, int(v))]
+                break
+
+            if type(arr_host.p) == type(None):
+                # then host not an array, so must be hash time
+                arr_host.p = {}
+
+            if type(arr_host.p) == dict:
+                if x not in arr_host.p:
+                    arr_host.p[x] = Pointer()
+                arr_host = arr_host.p[x]
+            elif type(arr_host.p) == list:
+                arr_host = arr_host.p[int(x)]
+            else:
+                assert False
+
+            if remaining == 0:
+                arr_host.p = v
+
+    def depointerise(x):
+        if type(x) == Pointer:
+            return depointerise(x.p)
+        elif type(x) == list:
+            return [depointerise(i) for i in x]
+        elif type(x) == dict:
+            return {k: depointerise(v) for k, v in x.items()}
+        return x
+
+    for k, v in depointerise(arrays).items():
+        ra[k] = json.dumps(v)
+    return ra
+
+
+def bench_flatten(args):
+    random.seed(0)
+    for extra_attributes in args.attributes:
+        resources = [
+            synthetic_resource("aws_instance", i, extra_attributes)["primary"][
+                "attributes"
+            ]
+            for i in range(0, args.resources)
+        ]
+        for attributes in resources:
+            assert flatten_attributes(attributes) == legacy_flatten_attributes(
+                attributes
+            )
+        for name, fn in [
+            ("pointer tree", legacy_flatten_attributes),
+            ("single pass", flatten_attributes),
+        ]:
+            start = time.time()
+            for attributes in resources:
+                fn(attributes)
+            how_long = time.time() - start
+            pprint(
+                (
+                    name,
+                    len(resources[0]),
+                    "attributes",
+                    args.resources / how_long,
+                    "resources/sec",
+                )
+            )
+
+
+arg_parser = argparse.ArgumentParser(description="tf-explorer benchmarks")
+subparsers = arg_parser.add_subparsers(dest="bench", required=True)
+ingest_parser = subparsers.add_parser("ingest", help="state file ingest rows/sec")
+ingest_parser.add_argument("--files", type=int, default=200)
+ingest_parser.add_argument("--resources", type=int, default=100)
+ingest_parser.add_argument("--jobs", type=int, default=1)
+ingest_parser.set_defaults(func=bench_ingest)
+flatten_parser = subparsers.add_parser("flatten", help="flatmap attribute flattening")
+flatten_parser.add_argument("--resources", type=int, default=1000)
+flatten_parser.add_argument(
+    "--attributes", type=int, nargs="+", default=[0, 10, 100, 1000, 10000]
+)
+flatten_parser.set_defaults(func=bench_flatten)
+stream_parser = subparsers.add_parser("stream", help="state file reader peak memory")
+stream_parser.add_argument("--resources", type=int, default=2000)
+stream_parser.add_argument("--attributes", type=int, default=100)
+stream_parser.set_defaults(func=bench_stream)
+startup_parser = subparsers.add_parser("startup", help="tf-explorer -c cold start")
+startup_parser.add_argument("--files", type=int, default=20)
+startup_parser.add_argument("--resources", type=int, default=100)
+startup_parser.add_argument("--repeat", type=int, default=10)
+startup_parser.set_defaults(func=bench_startup)
+loop_parser = subparsers.add_parser("loop", help=".loop query templates")
+loop_parser.add_argument("--resources", type=int, default=5000)
+loop_parser.add_argument("--queries", type=int, default=50)
+loop_parser.set_defaults(func=bench_loop)
+tables_parser = subparsers.add_parser("tables", help="--json/--yaml table ingest")
+tables_parser.add_argument("--tables", type=int, default=10)
+tables_parser.add_argument("--rows", type=int, default=5000)
+tables_parser.add_argument(
+    "--memory", action="store_true", help="also trace peak memory, slower"
+)
+tables_parser.set_defaults(func=bench_tables)
+flowlog_parser = subparsers.add_parser("flowlog", help="flow log parser lines/sec")
+flowlog_parser.add_argument("--lines", type=int, default=1000000)
+flowlog_parser.set_defaults(func=bench_flowlog)
+flowcache_parser = subparsers.add_parser(
+    "flowcache", help="flowparse cache reload and merge"
+)
+flowcache_parser.add_argument("--files", type=int, default=20)
+flowcache_parser.add_argument("--lines", type=int, default=200000)
+flowcache_parser.set_defaults(func=bench_flowcache)
+types_parser = subparsers.add_parser("types", help="typed vs text columns")
+types_parser.add_argument("--files", type=int, default=200)
+types_parser.add_argument("--resources", type=int, default=500)
+types_parser.add_argument("--repeat", type=int, default=20)
+types_parser.set_defaults(func=bench_types)
+udf_parser = subparsers.add_parser("udf", help="IP address SQL functions")
+udf_parser.add_argument("--calls", type=int, default=1000000)
+udf_parser.add_argument("--hosts", type=int, default=256)
+udf_parser.set_defaults(func=bench_udf)
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    args.func(args)
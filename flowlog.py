@@ -0,0 +1,531 @@
+import gzip
+import json
+import os
+import zlib
+import numpy as np
+
+BLOCK_SIZE = 1 << 24  # decompressed bytes parsed at a time
+MAX_FIELD = 64  # lines with a longer field go the slow way
+KEY = ("account", "interface", "src", "dst")
+# header names of the fields read; a custom format may leave out
+# interface-id, which then reads as "0"
+HEADINGS = {
+    "account": "account-id",
+    "interface": "interface-id",
+    "src": "srcaddr",
+    "dst": "dstaddr",
+    "bytes": "bytes",
+    "protocol": "protocol",
+}
+# src and dst hold IPv4 addresses as integers; anything else (IPv6) is
+# NOT_IPV4 plus its index in the address dictionary
+NOT_IPV4 = 1 << 32
+COLUMN_TYPES = {
+    "account": np.uint32,
+    "interface": np.uint32,
+    "src": np.uint64,
+    "dst": np.uint64,
+    "bytes": np.int64,
+}
+EMPTY = np.array([], dtype="S8")
+# cache files: CACHE_MAGIC, version and header length as uint32s, a JSON
+# header giving the dtype, offset and length of each array, then the arrays,
+# each 8 byte aligned, so they can be read straight from a memory map
+CACHE_MAGIC = b"FLOWTBL\0"
+CACHE_VERSION = 1
+MERGE_ROWS = 1 << 22  # rows a reducer collects before merging them
+
+
+class FlowTable:
+    # flow log records summed per (account, interface, src, dst), one numpy
+    # array per column, sorted by key; account and interface are indexes into
+    # sorted arrays of their distinct values
+    def __init__(self, columns, dictionaries, rows=0):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.rows = rows  # log lines read
+
+    def __len__(self):
+        return len(self.columns["bytes"])
+
+    def strings(self, name):
+        # a column as python strings, IPv4 addresses in dotted form
+        col = self.columns[name]
+        if name in ("account", "interface"):
+            return [v.decode() for v in self.dictionaries[name][col]]
+        values, inverse = np.unique(col, return_inverse=True)
+        strs = [address_string(v, self.dictionaries["address"]) for v in values]
+        return [strs[idx] for idx in inverse]
+
+    def key_strings(self, fields=KEY):
+        # "value value ..." of fields for each row
+        return list(map(" ".join, zip(*(self.strings(name) for name in fields))))
+
+    def key_bytes(self):
+        # {"account interface src dst": bytes}
+        return dict(zip(self.key_strings(), self.columns["bytes"].tolist()))
+
+
+def address_string(v, address_dictionary):
+    v = int(v)
+    if v >= NOT_IPV4:
+        return address_dictionary[v - NOT_IPV4].decode()
+    return f"{v >> 24}.{(v >> 16) & 255}.{(v >> 8) & 255}.{v & 255}"
+
+
+def field_columns(headings):
+    # {field: column} from the {heading: column} of a log's header line
+    return {
+        name: headings[heading]
+        for name, heading in HEADINGS.items()
+        if name != "interface" or heading in headings
+    }
+
+
+def gather(windows, starts, ends):
+    # the bytes from each start up to each end as a fixed width bytes array,
+    # a multiple of 8 wide so it can be read as uint64s
+    width = max(-(-int((ends - starts).max(initial=0)) // 8) * 8, 8)
+    chars = windows[starts, :width]
+    chars[np.arange(width) >= (ends - starts)[:, None]] = 0
+    return chars.view(f"S{width}").ravel()
+
+
+def is_char(region, starts, ends, c):
+    # fields of exactly the one character c
+    return ((ends - starts) == 1) & (region[starts] == ord(c))
+
+
+def split_block(buf, start, end, ncols, cols):
+    # {field: bytes array} for the lines in buf[start:end] worth keeping, or
+    # None unless every line has ncols fields separated by single spaces;
+    # buf must carry on MAX_FIELD bytes past end
+    region = buf[start:end]
+    seps = np.flatnonzero(region <= 32)
+    if len(seps) % ncols != 0:
+        return None, 0
+    ends = seps.reshape(-1, ncols)
+    if not (region[ends[:, -1]] == 10).all() or not (region[ends[:, :-1]] == 32).all():
+        return None, 0
+    line_starts = np.concatenate([[0], ends[:-1, -1] + 1])
+    spans = {
+        name: (line_starts if col == 0 else ends[:, col - 1] + 1, ends[:, col])
+        for name, col in cols.items()
+    }
+    nodata = is_char(region, *spans["src"], "-")
+    icmp = is_char(region, *spans.pop("protocol"), "1")
+    keep = ~(nodata | icmp)
+    spans = {name: (starts[keep], ends[keep]) for name, (starts, ends) in spans.items()}
+    if (
+        max((ends - starts).max(initial=0) for starts, ends in spans.values())
+        > MAX_FIELD
+    ):
+        return None, 0
+    # each field is the start of a row of this view
+    windows = np.lib.stride_tricks.sliding_window_view(buf[start:], MAX_FIELD + 8)
+    fields = {name: gather(windows, *span) for name, span in spans.items()}
+    return fields, len(line_starts)
+
+
+def split_lines(block, cols):
+    # split_block for lines it can't take: blank lines, extra spaces, CRLF
+    fields = {name: [] for name in cols if name != "protocol"}
+    lines = 0
+    for line in block.split(b"\n"):
+        row = line.rstrip().split(b" ")
+        if row == [b""]:
+            continue
+        lines += 1
+        if row[cols["src"]] == b"-" or row[cols["protocol"]] == b"1":
+            continue
+        for name, values in fields.items():
+            values.append(row[cols[name]])
+    return {
+        name: np.array(values, dtype=bytes) for name, values in fields.items()
+    }, lines
+
+
+def words(values):
+    # (len, width / 8) uint64 matrix of a fixed width bytes array
+    width = -(-values.dtype.itemsize // 8) * 8
+    values = np.ascontiguousarray(values, dtype=f"S{width}")
+    return values.view(np.uint64).reshape(len(values), width // 8)
+
+
+def hash_rows(columns):
+    # a 64 bit hash of each row of some fixed width bytes arrays
+    h = np.full(len(columns[0]), 0xCBF29CE484222325, dtype=np.uint64)
+    for col in columns:
+        for word in words(col).T:
+            h ^= word
+            h *= np.uint64(0x9E3779B97F4A7C15)
+            h ^= h >> np.uint64(29)
+    return h
+
+
+def group_rows(columns):
+    # (index of the first row, group of each row) for the distinct rows of
+    # some bytes arrays; grouped on their hash, so sorting integers rather
+    # than strings, unless two keys share one
+    h = hash_rows(columns)
+    order = np.argsort(h)
+    h = h[order]
+    change = np.empty(len(h), dtype=bool)
+    change[:1] = True
+    change[1:] = h[1:] != h[:-1]
+    first = order[change]
+    inverse = np.empty(len(h), dtype=np.intp)
+    inverse[order] = np.cumsum(change) - 1
+    if all((col[first][inverse] == col).all() for col in columns):
+        return first, inverse
+    rows = np.rec.fromarrays(columns)
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return first, inverse
+
+
+def parse_integers(values):
+    total = np.zeros(len(values), dtype=np.int64)
+    valid = np.ones(len(values), dtype=bool)
+    digits = np.zeros(len(values), dtype=np.int8)
+    for c in words(values).view(np.uint8).T:
+        digit = (c >= 48) & (c <= 57)
+        valid &= digit | (c == 0)
+        total = np.where(digit, total * 10 + (c.astype(np.int64) - 48), total)
+        digits += digit
+    valid &= (digits > 0) & (digits <= 18)
+    if not valid.all():
+        raise Exception(f"not a number: {values[~valid][0]!r}")
+    return total
+
+
+def encode_addresses(values):
+    # IPv4 addresses as integers, everything else via the returned dictionary
+    matrix = words(values).view(np.uint8)
+    ip = np.zeros(len(values), dtype=np.uint64)
+    octet = np.zeros(len(values), dtype=np.uint64)
+    digits = np.zeros(len(values), dtype=np.int8)
+    dots = np.zeros(len(values), dtype=np.int8)
+    # nothing over 15 characters is an IPv4 address
+    valid = (matrix[:, 15:] == 0).all(axis=1)
+    for c in matrix[:, :15].T:
+        digit = (c >= 48) & (c <= 57)
+        dot = c == 46
+        valid &= digit | (dot & (digits > 0)) | (c == 0)
+        octet = np.where(digit, octet * 10 + (c.astype(np.uint64) - 48), octet)
+        digits = np.where(dot, 0, digits + digit)
+        valid &= (octet <= 255) & (digits <= 3)
+        ip = np.where(dot, (ip << np.uint64(8)) | octet, ip)
+        octet[dot] = 0
+        dots += dot
+    ip = (ip << np.uint64(8)) | octet
+    valid &= (dots == 3) & (digits > 0)
+    if valid.all():
+        return ip, EMPTY
+    dictionary, inverse = np.unique(values[~valid], return_inverse=True)
+    ip[~valid] = inverse.astype(np.uint64) + np.uint64(NOT_IPV4)
+    return ip, dictionary
+
+
+def key_order(columns):
+    # (argsort by KEY, packed keys): sorted by address, then a stable, radix
+    # when it fits in 16 bits, sort on the few (account, interface) pairs
+    interfaces = int(columns["interface"].max(initial=0)) + 1
+    pair = columns["account"].astype(np.uint64) * np.uint64(interfaces)
+    pair += columns["interface"]
+    if pair.max(initial=0) < 1 << 16:
+        pair = pair.astype(np.uint16)
+    src, dst = columns["src"], columns["dst"]
+    if max(src.max(initial=0), dst.max(initial=0)) < NOT_IPV4:
+        addresses = [(src << np.uint64(32)) | dst]
+        order = np.argsort(addresses[0])
+    else:
+        addresses = [src, dst]
+        order = np.lexsort([dst, src])
+    order = order[np.argsort(pair[order], kind="stable")]
+    return order, [pair] + addresses
+
+
+def reduce_columns(columns):
+    # one row per distinct key, bytes summed, sorted by key
+    order, keys = key_order(columns)
+    if len(order) == 0:
+        return columns
+    change = np.zeros(len(order), dtype=bool)
+    change[0] = True
+    for key in keys:
+        key = key[order]
+        change[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(change)
+    reduced = {name: columns[name][order[starts]] for name in KEY}
+    reduced["bytes"] = np.add.reduceat(columns["bytes"][order], starts)
+    return reduced
+
+
+def fields_table(fields, rows):
+    # FlowTable of account, interface, src and dst bytes arrays and integer
+    # bytes
+    if "interface" not in fields:
+        fields["interface"] = np.full(len(fields["src"]), b"0")
+    # sum bytes per distinct key first, so the rest only sees distinct keys
+    first, inverse = group_rows([fields[name] for name in KEY])
+    byte_counts = np.zeros(len(first), dtype=np.int64)
+    np.add.at(byte_counts, inverse, fields["bytes"])
+    fields = {name: fields[name][first] for name in KEY}
+    columns = {"bytes": byte_counts}
+    dictionaries = {}
+    for name in ("account", "interface"):
+        dictionaries[name], codes = np.unique(fields[name], return_inverse=True)
+        columns[name] = codes.astype(np.uint32)
+    addresses, codes = np.unique(
+        np.concatenate([fields["src"], fields["dst"]]), return_inverse=True
+    )
+    ip, dictionaries["address"] = encode_addresses(addresses)
+    columns["src"], columns["dst"] = np.split(ip[codes], 2)
+    return FlowTable(reduce_columns(columns), dictionaries, rows)
+
+
+def merge_tables(tables):
+    # one FlowTable from several, their dictionaries merged
+    dictionaries = {
+        name: np.unique(
+            np.concatenate([EMPTY] + [t.dictionaries[name] for t in tables])
+        )
+        for name in ("account", "interface", "address")
+    }
+    parts = {name: [np.zeros(0, dtype)] for name, dtype in COLUMN_TYPES.items()}
+    for t in tables:
+        for name in ("account", "interface"):
+            remap = np.searchsorted(dictionaries[name], t.dictionaries[name])
+            parts[name].append(remap.astype(np.uint32)[t.columns[name]])
+        remap = np.searchsorted(dictionaries["address"], t.dictionaries["address"])
+        remap = remap.astype(np.uint64) + np.uint64(NOT_IPV4)
+        for name in ("src", "dst"):
+            col = t.columns[name].copy()
+            other = col >= NOT_IPV4
+            col[other] = remap[col[other] - np.uint64(NOT_IPV4)]
+            parts[name].append(col)
+        parts["bytes"].append(t.columns["bytes"])
+    columns = {name: np.concatenate(part) for name, part in parts.items()}
+    rows = sum(t.rows for t in tables)
+    return FlowTable(reduce_columns(columns), dictionaries, rows)
+
+
+def lines_table(lines, ncols, cols):
+    # FlowTable of a few lines, copied so they're followed by MAX_FIELD bytes
+    buf = np.frombuffer(lines + bytes(MAX_FIELD + 8), dtype=np.uint8)
+    return block_table(buf, 0, len(lines), ncols, cols)
+
+
+def block_table(buf, start, end, ncols, cols):
+    fields, lines = split_block(buf, start, end, ncols, cols)
+    if fields is None:
+        fields, lines = split_lines(buf[start:end].tobytes(), cols)
+    fields["bytes"] = parse_integers(fields["bytes"])
+    return fields_table(fields, lines)
+
+
+def read_flow_log(logfile, block_size=BLOCK_SIZE):
+    # FlowTable of a gzipped flow log, parsed block_size bytes at a time; the
+    # lines either side of a block boundary are parsed on their own, so the
+    # blocks themselves aren't copied
+    with gzip.open(logfile, mode="rb") as f:
+        header = f.readline().rstrip().split(b" ")
+        headings = {heading.decode(): idx for idx, heading in enumerate(header)}
+        cols = field_columns(headings)
+        tables = []
+        rest = b""
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            start = block.find(b"\n") + 1
+            # the last line ending that leaves a window's worth of bytes after
+            # it; a short block (the last, or a small block_size) has none
+            end = block.rfind(b"\n", 0, max(len(block) - MAX_FIELD - 8, 0)) + 1
+            if start == 0 or end <= start:
+                rest += block
+                continue
+            tables.append(lines_table(rest + block[:start], len(header), cols))
+            buf = np.frombuffer(block, dtype=np.uint8)
+            tables.append(block_table(buf, start, end, len(header), cols))
+            rest = block[end:]
+        if len(rest.strip()) > 0:
+            if not rest.endswith(b"\n"):
+                rest += b"\n"
+            tables.append(lines_table(rest, len(header), cols))
+    if len(tables) == 1:
+        return tables[0]
+    return merge_tables(tables)
+
+
+def select_rows(table, mask):
+    columns = {name: col[mask] for name, col in table.columns.items()}
+    return FlowTable(columns, table.dictionaries, table.rows)
+
+
+def project(table, fields):
+    # table with the KEY columns not in fields all zero, so merging it sums
+    # over them
+    columns = dict(table.columns)
+    dictionaries = dict(table.dictionaries)
+    for name in KEY:
+        if name not in fields:
+            columns[name] = np.zeros(len(table), dtype=COLUMN_TYPES[name])
+            if name in dictionaries:
+                dictionaries[name] = np.array([b""], dtype="S8")
+    return FlowTable(columns, dictionaries, table.rows)
+
+
+def string_hashes(dictionary):
+    return np.array([zlib.crc32(v) for v in dictionary], dtype=np.uint64)
+
+
+def partition(table, fields, shards):
+    # the shard of each row, from a hash of its fields' values rather than
+    # their codes, which differ from table to table
+    h = np.zeros(len(table), dtype=np.uint64)
+    for name in fields:
+        col = table.columns[name].astype(np.uint64)
+        if name in ("account", "interface"):
+            values = string_hashes(table.dictionaries[name])[col]
+        else:
+            values = col.copy()
+            other = col >= NOT_IPV4
+            address_hashes = string_hashes(table.dictionaries["address"])
+            values[other] = address_hashes[col[other] - np.uint64(NOT_IPV4)]
+        h ^= values
+        h *= np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(29)
+    return h % np.uint64(shards)
+
+
+def split_table(table, fields, shards, sign=1):
+    # table summed over fields, times sign, as one FlowTable per shard
+    table = merge_tables([project(table, fields)])
+    if sign < 0:
+        table.columns["bytes"] = -table.columns["bytes"]
+    part = partition(table, fields, shards)
+    # stable, so each shard's rows stay in key order
+    order = np.argsort(part, kind="stable")
+    bounds = np.searchsorted(part[order], np.arange(1, shards, dtype=np.uint64))
+    return [select_rows(table, idx) for idx in np.split(order, bounds)]
+
+
+def reduce_shard(piece_files, merge_rows=MERGE_ROWS):
+    # (FlowTable summing one shard's pieces, rows read)
+    merged = merge_tables([])
+    parts = []
+    pending = 0
+    rows_read = 0
+    for piece_file in piece_files:
+        part = read_cache(piece_file)
+        rows_read += len(part)
+        parts.append(part)
+        pending += len(part)
+        if pending > merge_rows:
+            merged = merge_tables([merged] + parts)
+            parts = []
+            pending = 0
+    return merge_tables([merged] + parts), rows_read
+
+
+def aligned(offset):
+    return -(-offset // 8) * 8
+
+
+def write_cache(filename, table, source=None):
+    # table in the cache format, via a temporary file so readers never see a
+    # partly written one; source, any JSON, says what it was made from
+    arrays = [("column", name, table.columns[name]) for name in COLUMN_TYPES]
+    arrays += [("dictionary", name, d) for name, d in table.dictionaries.items()]
+    # key columns in the smallest type that holds them: a few accounts fit
+    # a byte, addresses four unless some are IPv6
+    for idx, (kind, name, values) in enumerate(arrays):
+        if kind == "column" and name in KEY:
+            dtype = np.min_scalar_type(int(values.max(initial=0)))
+            arrays[idx] = (kind, name, values.astype(dtype))
+    entries = []
+    offset = 0
+    for kind, name, values in arrays:
+        values = np.ascontiguousarray(values)
+        entries.append(
+            {
+                "kind": kind,
+                "name": name,
+                "dtype": values.dtype.str,
+                "offset": offset,
+                "length": len(values),
+            }
+        )
+        offset = aligned(offset + values.nbytes)
+    header = {"rows": table.rows, "arrays": entries}
+    if source is not None:
+        header["source"] = source
+    header = json.dumps(header).encode()
+    start = aligned(len(CACHE_MAGIC) + 8 + len(header))
+    with open(filename + ".tmp", "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(np.array([CACHE_VERSION, len(header)], dtype="<u4").tobytes())
+        f.write(header)
+        for entry, (kind, name, values) in zip(entries, arrays):
+            f.seek(start + entry["offset"])
+            f.write(np.ascontiguousarray(values).tobytes())
+        f.truncate(start + offset)
+    os.rename(filename + ".tmp", filename)
+
+
+def read_cache(filename, migrate=False):
+    # FlowTable whose arrays are views of the memory mapped cache file; the
+    # gzipped pickles of earlier versions are read too, and with migrate
+    # rewritten in this format
+    with open(filename, "rb") as f:
+        magic = f.read(len(CACHE_MAGIC))
+    if magic[:2] == b"\x1f\x8b":
+        table = read_pickle_cache(filename)
+        if migrate:
+            write_cache(filename, table)
+        return table
+    if magic != CACHE_MAGIC:
+        raise Exception(f"{filename} is not a flow cache")
+    mm = np.memmap(filename, dtype=np.uint8, mode="r")
+    version, header_len = map(
+        int, np.frombuffer(mm, dtype="<u4", count=2, offset=len(magic))
+    )
+    if version != CACHE_VERSION:
+        raise Exception(f"{filename} is flow cache version {version}")
+    header_start = len(magic) + 8
+    header = json.loads(mm[header_start : header_start + header_len].tobytes())
+    start = aligned(header_start + header_len)
+    arrays = {"column": {}, "dictionary": {}}
+    for entry in header["arrays"]:
+        arrays[entry["kind"]][entry["name"]] = np.frombuffer(
+            mm,
+            dtype=entry["dtype"],
+            count=entry["length"],
+            offset=start + entry["offset"],
+        )
+    return FlowTable(arrays["column"], arrays["dictionary"], header["rows"])
+
+
+def cache_source(filename):
+    # the source a cache was written with, None if it has none or is from an
+    # earlier version
+    with open(filename, "rb") as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        version, header_len = np.frombuffer(f.read(8), dtype="<u4").tolist()
+        if version != CACHE_VERSION:
+            return None
+        return json.loads(f.read(header_len)).get("source")
+
+
+def read_pickle_cache(filename):
+    # FlowTable of an earlier version's {"account interface src dst": bytes}
+    import pickle
+
+    with gzip.open(filename, mode="rb") as f:
+        tuple_dict, rows = pickle.load(f)
+    fields = dict(zip(KEY, zip(*(k.split(" ") for k in tuple_dict))))
+    fields = {name: np.array(fields.get(name, []), dtype="S") for name in KEY}
+    fields["bytes"] = np.fromiter(tuple_dict.values(), dtype=np.int64)
+    return fields_table(fields, rows)
@@ -1,6 +1,4 @@
 from multiprocessing import Pool, cpu_count
-import threading
-import queue
 from pprint import pprint
 import sys
 import os
@@ -13,7 +11,20 @@ import asyncio
 import io
 import subprocess
 import sqlite3
-import time
+import socket
+import heapq
+import itertools
+import tempfile
+from flowlog import (
+    cache_source,
+    merge_tables,
+    read_cache,
+    read_flow_log,
+    reduce_shard,
+    select_rows,
+    split_table,
+    write_cache,
+)
 
 arg_parser = argparse.ArgumentParser(description="Parse and combine flow logs")
 arg_parser.add_argument("flowdir", nargs="+", action="store")
@@ -21,295 +32,474 @@ arg_parser.add_argument("--summary-file", nargs="?")
 arg_parser.add_argument("--sqlite-file", nargs="?")
 arg_parser.add_argument("--summary-fields", nargs="?", default="src,dst")
 arg_parser.add_argument("--flowcache", nargs="?", default="cache")
+arg_parser.add_argument("--jobs", type=int, default=max(cpu_count() - 4, 1))
+arg_parser.add_argument("--shards", type=int, default=cpu_count())
+# what to do about logs added to --sqlite-file that have since gone
+arg_parser.add_argument(
+    "--missing", choices=["fail", "keep", "subtract"], default="fail"
+)
+# IPv4 src and dst as integers, in table flow_ip, with flow a view of it
+arg_parser.add_argument("--int-ips", action="store_true")
 args = arg_parser.parse_args()
 
 do_summary = (args.summary_file is not None) or (args.sqlite_file is not None)
 summary_fields = args.summary_fields.split(",")
 cache_root = args.flowcache
 
-if args.sqlite_file:
-    assert not os.path.exists(args.sqlite_file)
-
-rkey_list = []
-summary_keys = []
-for idx, k in enumerate(["interface", "account", "src", "dst"]):
-    if k in summary_fields:
-        rkey_list.append("fields[%i]" % idx)
-        summary_keys.append(k)
+summary_keys = [
+    k for k in ["interface", "account", "src", "dst"] if k in summary_fields
+]
+IPS = {"src", "dst"}
 
-rkey_expr = (
-    '"' + (" ".join(["%s"] * len(summary_fields))) + '" % (' + ",".join(rkey_list) + ")"
-)
 
+def process_single_log(logfile, cache_file, source):
+    assert logfile.endswith(".gz")
 
-def simplify_row_key(k):
-    assert False
-
-
-exec(
-    """
-def simplify_row_key(k):
-    fields = k.split(' ')
-    return %s
-"""
-    % rkey_expr
-)
-
+    table = read_flow_log(logfile)
+    write_cache(cache_file, table, source)
 
-def process_single_log(logfile, cache_file):
-    assert logfile.endswith(".gz")
+    return cache_file, table.rows
 
-    tuple_dict = {}
-    rows = 0
-    with gzip.open(logfile, mode="rt") as f:
-        headings = {}
-        for idx, x in enumerate(f.readline().rstrip().split(" ")):
-            headings[x] = idx
-        interface_col = headings.get("interface-id", -1)
-        account_col = headings["account-id"]
-        src_col = headings["srcaddr"]
-        dst_col = headings["dstaddr"]
-        bytes_col = headings["bytes"]
-        protocol_col = headings["protocol"]
-        for line in f:
-            row = line.rstrip().split(" ")
-            #        for row in csv.DictReader(f, delimiter=' '):
-            rows += 1
-            try:
-                src = row[src_col]
-                if src == "-":
-                    continue
-                protocol = row[protocol_col]
-                if protocol == "1":  # skip ICMP
-                    continue
-                dst = row[dst_col]
-                key = "%s %s %s %s" % (
-                    row[account_col],
-                    row[interface_col] if interface_col != -1 else "0",
-                    src,
-                    dst,
-                )
-                bytes = int(row[bytes_col])
-                if key in tuple_dict:
-                    tuple_dict[key] += bytes
-                else:
-                    tuple_dict[key] = bytes
-            except:
-                pprint(row)
-                raise
 
-    with gzip.open(cache_file + ".tmp", mode="wb") as f:
-        pickle.dump((tuple_dict, rows), f)
-    os.rename(cache_file + ".tmp", cache_file)
+def read_cached(cache_file):
+    # migrates old pickle caches once, here, rather than in every reducer
+    return cache_file, read_cache(cache_file, migrate=True).rows
 
-    return cache_file
 
+def combine_folder(folder_cache_file, cache_files, source):
+    tables = [read_cache(cache_file, migrate=True) for cache_file in cache_files]
+    folder_combined = merge_tables(tables)
 
-def combine_summary(master, addition):
-    for k_, v in addition.items():
-        k = simplify_row_key(k_)
-        if k not in master:
-            master[k] = v
-        else:
-            master[k] += v
-
-
-results_lock = threading.Lock()
-
-
-def add_result(results, k, v):
-    with results_lock:
-        results[k] = v
-
-
-def check_for_results(results, q):
-    last_result = None
-    with results_lock:
-        done = []
-        for cache_file, i in results.items():
-            if i.ready():
-                _result = i.get()
-                assert _result == cache_file
-
-                if do_summary:
-                    q.put(cache_file)
-                done.append(cache_file)
-            else:
-                last_result = i
-        for cache_file in done:
-            del results[cache_file]
-
-    return last_result, len(done)
-
-
-def combine_folder(folder_cache_file, cache_files):
-    folder_combined = {}
-    folder_rows = 0
-    dict_rows = 0
-    for cache_file in cache_files:
-        with gzip.open(cache_file, mode="rb") as f:
-            file_data = pickle.load(f)
-        tuple_dict, rows = file_data
-        dict_rows += len(tuple_dict)
-        folder_rows += rows
-        for k, v in tuple_dict.items():
-            if k not in folder_combined:
-                folder_combined[k] = v
-            else:
-                folder_combined[k] += v
-
-    with gzip.open(folder_cache_file + ".tmp", mode="wb") as f:
-        pickle.dump((folder_combined, folder_rows), f)
-    os.rename(folder_cache_file + ".tmp", folder_cache_file)
+    write_cache(folder_cache_file, folder_combined, source)
+    dict_rows = sum(len(table) for table in tables)
     pprint(("combine_folder", folder_cache_file, dict_rows, len(folder_combined)))
-    return folder_cache_file
+    return folder_cache_file, folder_combined.rows
+
+
+def log_source(logfile):
+    stat = os.stat(logfile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def cache_matches(cache_file, source):
+    # whether cache_file was parsed from the log as source describes it;
+    # caches from earlier versions don't say, so go by when they were written
+    if not os.path.exists(cache_file):
+        return False
+    written = cache_source(cache_file)
+    if written is None:
+        return os.stat(cache_file).st_mtime_ns >= source[1]
+    return written == source
+
+
+def read_manifest(sqlite_file):
+    # {log: [size, mtime_ns]} of the logs already summed into sqlite_file
+    if not os.path.exists(sqlite_file):
+        return {}
+    db = sqlite3.connect(sqlite_file)
+    tables = {r[0] for r in db.execute("select name from sqlite_master;")}
+    if "flow" not in tables:
+        return {}
+    # the table's columns: with --int-ips flow is a view with more of them
+    stored = "flow_ip" if "flow_ip" in tables else "flow"
+    cols = [r[1] for r in db.execute(f"pragma table_info({stored});")]
+    if cols != summary_keys + ["bytes"]:
+        raise Exception(f"{sqlite_file} sums {cols[:-1]}, not {summary_keys}")
+    if ("flow_ip" in tables) != args.int_ips:
+        raise Exception(
+            f"{sqlite_file} was {'not ' if args.int_ips else ''}written with --int-ips"
+        )
+    if "flow_manifest" not in tables:
+        raise Exception(f"{sqlite_file} has no manifest of its logs to add to")
+    manifest = {
+        path: [size, mtime_ns]
+        for path, size, mtime_ns in db.execute(
+            "select path, size, mtime_ns from flow_manifest;"
+        )
+    }
+    db.close()
+    return manifest
+
+
+def run_job(job):
+    return job[0](*job[1:])
+
+
+def split_worker(cache_file, sign, piece_files, zero_file=None):
+    # one cache summed over summary_keys, times sign, and split into a piece
+    # per shard; the keys it sums to no bytes to zero_file, when given
+    table = read_cache(cache_file)
+    pieces = split_table(table, summary_keys, len(piece_files), sign)
+    zero = []
+    for piece, piece_file in zip(pieces, piece_files):
+        write_cache(piece_file, piece)
+        if zero_file is not None:
+            zero += select_rows(piece, piece.columns["bytes"] == 0).key_strings(
+                summary_keys
+            )
+    if len(zero) > 0:
+        with open(zero_file, "wb") as f:
+            pickle.dump(zero, f)
+    return len(table)
+
+
+def reduce_worker(shard, piece_files, retract_files, run_file):
+    # one hash partition of the keys, written to run_file as pickled
+    # (key, bytes) pairs in key order, and the keys retract_files had to
+    # run_file.retracted
+    start_reduce = time.time()
+    table, rows_read = reduce_shard(piece_files + retract_files)
+    if len(retract_files) > 0:
+        retracted, _ = reduce_shard(retract_files)
+        with open(run_file + ".retracted", "wb") as f:
+            pickle.dump(retracted.key_strings(summary_keys), f)
+    keys = table.key_strings(summary_keys)
+    values = table.columns["bytes"].tolist()
+    with open(run_file, "wb") as f:
+        for idx in sorted(range(len(keys)), key=keys.__getitem__):
+            pickle.dump((keys[idx], values[idx]), f)
+    how_long = time.time() - start_reduce
+    pprint(("reduce", shard, rows_read, len(keys), rows_read / how_long))
+    return rows_read, len(keys)
+
+
+def reduce(cache_files, retract_files=()):
+    # (temporary directory, run files, keys) of the sum over summary_keys of
+    # cache_files less retract_files; each cache is read once, and split
+    # into a piece per shard for the shard's reducer.  The keys cache_files[i]
+    # sums to no bytes go to zero_file(run_dir, i)
+    start_split = time.time()
+    run_dir = tempfile.TemporaryDirectory()
+    signed = [(f, 1) for f in cache_files] + [(f, -1) for f in retract_files]
+    pieces = [
+        [os.path.join(run_dir.name, f"{idx}.{shard}") for shard in range(args.shards)]
+        for idx in range(len(signed))
+    ]
+    run_files = [
+        os.path.join(run_dir.name, f"{shard}.run") for shard in range(args.shards)
+    ]
+    with Pool(args.shards) as pool:
+        rows_read = sum(
+            pool.starmap(
+                split_worker,
+                [
+                    (f, sign, p, zero_file(run_dir, idx) if sign > 0 else None)
+                    for idx, ((f, sign), p) in enumerate(zip(signed, pieces))
+                ],
+            )
+        )
+        how_long = time.time() - start_split
+        pprint(("split", len(signed), rows_read, rows_read / how_long))
+        start_reduce = time.time()
+        reduced = pool.starmap(
+            reduce_worker,
+            [
+                (
+                    shard,
+                    [p[shard] for p in pieces[: len(cache_files)]],
+                    [p[shard] for p in pieces[len(cache_files) :]],
+                    run_file,
+                )
+                for shard, run_file in enumerate(run_files)
+            ],
+        )
+    rows_reduced = sum(r[0] for r in reduced)
+    summary_count = sum(r[1] for r in reduced)
+    how_long = time.time() - start_reduce
+    pprint(("reduced", rows_reduced, summary_count, rows_reduced / how_long))
+    return run_dir, run_files, summary_count
+
+
+def zero_file(run_dir, idx):
+    return os.path.join(run_dir.name, f"{idx}.zero")
+
+
+def ip_value(ip):
+    # IPv4 as an integer, anything else (IPv6) as it is
+    if ":" in ip:
+        return ip
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def sqlite_key(k):
+    # a summary key as the values of sqlite_file's flow table key columns
+    row = k.split(" ")
+    if args.int_ips:
+        for idx, name in enumerate(summary_keys):
+            if name in IPS:
+                row[idx] = ip_value(row[idx])
+    return row
+
+
+def sqlite_rows(run_files):
+    # the summary's rows as sqlite_file's flow table holds them, in any
+    # order, so no need to merge the runs
+    for k, v in itertools.chain(*map(read_run, run_files)):
+        row = sqlite_key(k)
+        row.append(v)
+        yield row
 
 
-def combine_worker(results, combine_q):
+def zero_rows(run_dir, logfiles):
+    # (path, key values) of the keys each of the logs reduce() was given the
+    # caches of sums to no bytes, for flow_zero
+    for idx, logfile in enumerate(logfiles):
+        if os.path.exists(zero_file(run_dir, idx)):
+            with open(zero_file(run_dir, idx), "rb") as f:
+                for k in pickle.load(f):
+                    yield [logfile] + sqlite_key(k)
 
-    total_rows = 0
-    start_time = time.time()
-    last_status = start_time
-    total_q = 0
 
-    while True:
-        item = combine_q.get()
+def retracted_keys(run_files):
+    for run_file in run_files:
+        if os.path.exists(run_file + ".retracted"):
+            with open(run_file + ".retracted", "rb") as f:
+                yield from map(sqlite_key, pickle.load(f))
 
-        if item is False:  # sentinel, end
-            combine_q.task_done()
-            return
 
-        with gzip.open(item, mode="rb") as f:
-            combine_data = pickle.load(f)
-        tuple_dict, rows = combine_data
+def dotted(col):
+    # sql rendering integer column col in dotted form, any text as it is
+    return f"""case when typeof({col}) = 'integer' then
+({col} >> 24) || '.' || ({col} >> 16 & 255) || '.' || ({col} >> 8 & 255) || '.' ||
+({col} & 255) else {col} end as {col}"""
 
-        combine_summary(summary, tuple_dict)
 
-        total_q += 1
+def read_run(run_file):
+    with open(run_file, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
-        total_rows += rows
 
-        combine_q.task_done()
-        check_for_results(results, combine_q)
-        time.sleep(0)
-        if (time.time() - last_status) > 0.8:
-            last_status = time.time()
-            how_long = last_status - start_time
-            pprint(
-                (
-                    total_rows,
-                    total_rows / how_long,
-                    total_q / how_long,
-                    len(results),
-                    combine_q.qsize(),
-                )
-            )
+def summary_rows(run_files):
+    # every (key, bytes) of the summary, in key order
+    return heapq.merge(*map(read_run, run_files))
 
 
 if __name__ == "__main__":  # not multiprocess
-    summary = {}
-    results = {}
-    to_combine = queue.Queue()
-    combine_thread = threading.Thread(target=combine_worker, args=(results, to_combine))
-    combine_thread.start()
-
-    with Pool(cpu_count() - 4) as pool:
-        running = 0
-        for flowdir in args.flowdir:
-            for folder, subfolders, files in os.walk(flowdir, topdown=False):
-                cached = []
-                uncached = False
-                folder_cache_file = os.path.join(cache_root, folder + ".folder")
-                for logfile in map(lambda x: os.path.join(folder, x), files):
-                    cache_file = os.path.join(cache_root, logfile)
-                    cache_folder = os.path.dirname(cache_file)
-
-                    if os.path.exists(cache_file):
-                        cached.append(cache_file)
-                    elif logfile.endswith(".gz"):
-                        uncached = True
-                        # invalidate folder cache
-                        if os.path.exists(folder_cache_file):
-                            pprint(("invalidate folder cache", folder_cache_file))
-                            os.remove(folder_cache_file)
-                        if not os.path.exists(cache_folder):
-                            os.makedirs(os.path.join(cache_folder))
-                        add_result(
-                            results,
-                            cache_file,
-                            pool.apply_async(process_single_log, (logfile, cache_file)),
-                        )
-                        running += 1
-                        if running > 10:
-                            check_for_results(results, to_combine)
-                            running = 0
-                if len(cached) > 0 and uncached is False:
-                    # candidate for folder_cache:
-                    if not os.path.exists(folder_cache_file):
-                        add_result(
-                            results,
-                            folder_cache_file,
-                            pool.apply_async(
-                                combine_folder, (folder_cache_file, cached)
-                            ),
-                        )
-                        running += 1
-                        if running > 10:
-                            check_for_results(results, to_combine)
-                            running = 0
-                    else:
-                        to_combine.put(folder_cache_file)
+    manifest = {}
+    if args.sqlite_file:
+        manifest = read_manifest(args.sqlite_file)
+    jobs = []
+    logs = {}  # {log: (cache file, source)}
+    for flowdir in args.flowdir:
+        for folder, subfolders, files in os.walk(flowdir, topdown=False):
+            cached = []
+            uncached = False
+            folder_cache_file = os.path.join(cache_root, folder + ".folder")
+            folder_source = []
+            for logfile in map(lambda x: os.path.join(folder, x), files):
+                if not logfile.endswith(".gz"):
+                    continue
+                cache_file = os.path.join(cache_root, logfile)
+                cache_folder = os.path.dirname(cache_file)
+                source = log_source(logfile)
+                logs[logfile] = (cache_file, source)
+                folder_source.append([os.path.basename(logfile)] + source)
+
+                if cache_matches(cache_file, source):
+                    cached.append(cache_file)
                 else:
-                    if do_summary:
-                        for cache_file in cached:
-                            to_combine.put(cache_file)
-
-        while len(results) > 0:
-            last_result, items_done = check_for_results(results, to_combine)
-            if items_done == 0:
-                last_result.wait(0.1)
-        to_combine.put(False)
-        combine_thread.join()
-        assert to_combine.empty()
+                    uncached = True
+                    if not os.path.exists(cache_folder):
+                        os.makedirs(os.path.join(cache_folder))
+                    jobs.append((process_single_log, logfile, cache_file, source))
+            folder_source.sort()
+            # the folder cache is only good for exactly the logs it was made of
+            if os.path.exists(folder_cache_file) and (
+                uncached or cache_source(folder_cache_file) != folder_source
+            ):
+                pprint(("invalidate folder cache", folder_cache_file))
+                os.remove(folder_cache_file)
+            if len(cached) > 0 and uncached is False:
+                # candidate for folder_cache:
+                if not os.path.exists(folder_cache_file):
+                    jobs.append(
+                        (combine_folder, folder_cache_file, cached, folder_source)
+                    )
+                elif args.summary_file:
+                    jobs.append((read_cached, folder_cache_file))
+            elif args.summary_file:
+                for cache_file in cached:
+                    jobs.append((read_cached, cache_file))
+
+    # logs to add to the sqlite file, and caches of what changed or went
+    # missing to take back out of it; a changed log's old cache is moved
+    # aside before it's reparsed over
+    added = [logfile for logfile in logs if manifest.get(logfile) != logs[logfile][1]]
+    changed = set(added) & set(manifest)
+    missing = [
+        logfile
+        for logfile in manifest
+        if logfile not in logs
+        and any(logfile.startswith(os.path.join(d, "")) for d in args.flowdir)
+    ]
+    if len(missing) > 0 and args.missing == "fail":
+        raise Exception(
+            f"{len(missing)} logs in {args.sqlite_file} are gone, e.g. "
+            f"{missing[0]}; --missing keep or subtract them"
+        )
+    retract_files = []
+    retracted = sorted(changed) + (missing if args.missing == "subtract" else [])
+    for logfile in retracted:
+        source = manifest[logfile]
+        cache_file = os.path.join(cache_root, logfile)
+        if cache_matches(cache_file + ".retract", source):
+            retract_files.append(cache_file + ".retract")
+        elif cache_matches(cache_file, source):
+            if logfile in changed:
+                os.rename(cache_file, cache_file + ".retract")
+                cache_file += ".retract"
+            retract_files.append(cache_file)
+        else:
+            raise Exception(
+                f"{logfile} changed or went since it was added to "
+                f"{args.sqlite_file}, and its cache with it"
+            )
+
+    # parse and cache, then (when summarising) reduce in shards
+    cache_files = []
+    total_lines = 0
+    start_time = time.time()
+    last_status = start_time
+    with Pool(args.jobs) as pool:
+        for cache_file, lines in pool.imap_unordered(run_job, jobs):
+            cache_files.append(cache_file)
+            total_lines += lines
+            if (time.time() - last_status) > 0.8:
+                last_status = time.time()
+                how_long = last_status - start_time
+                pprint(
+                    (
+                        len(cache_files),
+                        len(jobs),
+                        len(cache_files) / how_long,
+                        total_lines / how_long,
+                    )
+                )
+    how_long = time.time() - start_time
+    pprint(
+        (
+            "parsed",
+            len(cache_files),
+            total_lines,
+            len(cache_files) / how_long,
+            total_lines / how_long,
+        )
+    )
+
+    sqlite_runs = None  # nothing to add or take out
+    if args.sqlite_file and (len(added) > 0 or len(retract_files) > 0):
+        sqlite_runs = reduce([logs[logfile][0] for logfile in added], retract_files)
+    if args.summary_file:
+        if (
+            sqlite_runs is not None
+            and len(added) == len(logs)
+            and len(retract_files) == 0
+        ):
+            summary_runs = sqlite_runs  # the same sum
+        else:
+            summary_runs = reduce(cache_files)
 
 if args.summary_file:
+    run_dir, run_files, summary_count = summary_runs
     start_summary = time.time()
     with gzip.open(args.summary_file + ".tmp", mode="wb") as f:
         pickle.dump(summary_keys, f)
-        for k in sorted(summary.keys()):
-            pickle.dump((k, summary[k]), f)
+        for k, v in summary_rows(run_files):
+            pickle.dump((k, v), f)
     os.rename(args.summary_file + ".tmp", args.summary_file)
-    pprint(("summary written in ", time.time() - start_summary))
+    how_long = time.time() - start_summary
+    pprint(("summary written in ", how_long, summary_count / how_long))
 
 if args.sqlite_file:
     start_sqlite = time.time()
-    db = sqlite3.connect(args.sqlite_file)
-    cur = db.cursor()
-    cols = ",".join(summary_keys + ["bytes"])
+    db = sqlite3.connect(args.sqlite_file, isolation_level=None)
+    table = "flow_ip" if args.int_ips else "flow"
+    keys = ",".join(summary_keys)
     db.execute("PRAGMA journal_mode=WAL;")
     db.execute("PRAGMA synchronous = 0;")
-    db.execute(f"create table flow ({cols});")
-    for z in summary_keys:
-        db.execute(f"create index if not exists {z}_index on flow ({z});")
-
-    stmt = f"""insert into flow ({cols})
+    db.execute("PRAGMA cache_size = -262144;")  # 256MB, for building indexes
+    # one transaction, so a failed run leaves the file as it was
+    db.execute("begin;")
+    tables = {r[0] for r in db.execute("select name from sqlite_master;")}
+    # a new table is filled and then indexed, which is much quicker than
+    # keeping indexes up to date row by row; an existing one is added to
+    new = table not in tables
+    if new:
+        ip_type = "integer" if args.int_ips else "text"
+        types = [f"{k} {ip_type if k in IPS else 'text'}" for k in summary_keys]
+        db.execute(f"create table {table} ({','.join(types)}, bytes integer);")
+        db.execute("""create table flow_manifest
+(path text primary key, size integer, mtime_ns integer);""")
+    if args.int_ips:
+        # the dotted columns are expressions, so a filter on them can't use
+        # flow_ip's indexes; src_ip and dst_ip are the indexed integers.
+        # Made afresh each run, so files from before these columns get them
+        cols = [dotted(k) if k in IPS else k for k in summary_keys]
+        cols += [f"{k} as {k}_ip" for k in summary_keys if k in IPS]
+        db.execute("drop view if exists flow;")
+        db.execute(f"create view flow as select {','.join(cols)}, bytes from flow_ip;")
+
+    stmt = f"""insert into {table} ({keys},bytes)
 values ({','.join('?' * len(summary_keys))},?)"""
-    db.commit()
-    row_count = 0
-    batch = []
-
-    for k, v in summary.items():
-        row = k.split(" ")
-        row.append(v)
-
-        batch.append(row)
-
-        if len(batch) > 100:
-            db.executemany(stmt, batch)
-            db.commit()
-            batch = []
-
-    if len(batch) > 0:
-        db.executemany(stmt, batch)
-        db.commit()
-    pprint(("sqlite written in ", time.time() - start_sqlite))
+    if not new:
+        stmt += f" on conflict ({keys}) do update set bytes = bytes + excluded.bytes"
+    summary_count = 0
+    if sqlite_runs is not None:
+        run_dir, run_files, summary_count = sqlite_runs
+        db.executemany(stmt, sqlite_rows(run_files))
+    insert_time = time.time() - start_sqlite
+    if new:
+        start_index = time.time()
+        db.execute(f"create unique index flow_key on {table} ({keys});")
+        # flow_key serves for the first
+        for z in summary_keys[1:]:
+            db.execute(f"create index {z}_index on {table} ({z});")
+        pprint(("sqlite indexed in ", time.time() - start_index))
+    # the keys each log sums to no bytes: a retracted key that comes to
+    # nothing is still a flow while a log left has it
+    db.execute(f"create table if not exists flow_zero (path text, {keys});")
+    db.execute(f"create index if not exists flow_zero_key on flow_zero ({keys});")
+    db.executemany("delete from flow_zero where path = ?;", [(r,) for r in retracted])
+    if sqlite_runs is not None:
+        db.executemany(
+            f"insert into flow_zero values (?,{','.join('?' * len(summary_keys))});",
+            zero_rows(run_dir, added),
+        )
+    if len(retract_files) > 0:
+        # rows of retracted keys that came to nothing and that no log has;
+        # other rows with no bytes are real flows
+        where = " and ".join(f"{k} = ?" for k in summary_keys)
+        zero = " and ".join(f"flow_zero.{k} = {table}.{k}" for k in summary_keys)
+        db.executemany(
+            f"""delete from {table} where {where} and bytes = 0
+and not exists (select 1 from flow_zero where {zero});""",
+            retracted_keys(run_files),
+        )
+    if args.missing == "subtract":
+        db.executemany(
+            "delete from flow_manifest where path = ?;", [(m,) for m in missing]
+        )
+    db.executemany(
+        "insert or replace into flow_manifest values (?,?,?);",
+        [[logfile] + logs[logfile][1] for logfile in added],
+    )
+    db.execute("commit;")
+    for retract_file in retract_files:
+        if retract_file.endswith(".retract"):
+            os.remove(retract_file)
+    how_long = time.time() - start_sqlite
+    pprint(
+        (
+            "sqlite written in ",
+            how_long,
+            summary_count / how_long,
+            summary_count / insert_time,
+            len(added),
+            len(retract_files),
+            len(missing),
+        )
+    )
@@ -0,0 +1,109 @@
+import json
+import os
+import subprocess
+import sys
+
+EXPLORER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tf-explorer.py")
+
+
+def explorer(*argv, cwd):
+    return subprocess.run(
+        [sys.executable, EXPLORER] + list(argv),
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_parallel_script_metacommands(tmp_path):
+    with open(tmp_path / "t.json", "w") as f:
+        json.dump({"t": [{"a": "1"}, {"a": "2"}]}, f)
+    with open(tmp_path / "s.sql", "w") as f:
+        f.write("select count(*) from t;\n.cache\n.status\n")
+    run = explorer(
+        "--json", "t.json", "--parallel", "2", "--script", "s.sql", cwd=tmp_path
+    )
+    assert "syntax error" not in run.stdout + run.stderr
+    assert "('hits', 0)" in run.stdout
+    with open(tmp_path / "query-001.txt") as f:
+        assert "2" in f.read()
+
+
+def test_parallel_flowdb(tmp_path):
+    # workers open the snapshot, which doesn't hold the attached --flowdb
+    import sqlite3
+
+    flowdb = sqlite3.connect(tmp_path / "flow.db")
+    flowdb.execute("create table flow (src, dst, bytes);")
+    flowdb.executemany("insert into flow values (?,?,?);", [("a", "b", 1)] * 3)
+    flowdb.commit()
+    flowdb.close()
+    with open(tmp_path / "t.json", "w") as f:
+        json.dump({"t": [{"a": "1"}]}, f)
+    run = explorer(
+        "--json",
+        "t.json",
+        "--flowdb",
+        "flow.db",
+        "--parallel",
+        "2",
+        "-c",
+        "select count(*) as n from flowdb.flow;",
+        "-c",
+        "select count(*) as n from flow join t;",
+        cwd=tmp_path,
+    )
+    assert "no such table" not in run.stdout + run.stderr
+    for name in ["query-001.txt", "query-002.txt"]:
+        with open(tmp_path / name) as f:
+            assert "| 3 |" in f.read()
+
+
+def test_parallel_snapshot_not_written(tmp_path):
+    # nothing to load, so refresh writes no snapshot for the workers to open
+    run = explorer(
+        "--snapshot", "snap.db", "--parallel", "2", "-c", "select 7;", cwd=tmp_path
+    )
+    assert "error" not in run.stdout + run.stderr
+    with open(tmp_path / "query-001.txt") as f:
+        assert "7" in f.read()
+
+
+def test_query_stdout_is_only_results(tmp_path):
+    with open(tmp_path / "t.json", "w") as f:
+        json.dump({"t": [{"a": "1"}, {"a": "2"}]}, f)
+    run = explorer(
+        "--json", "t.json", "-c", "select count(*) as n from t;", cwd=tmp_path
+    )
+    assert run.stdout.split() == [
+        "+---+",
+        "|",
+        "n",
+        "|",
+        "+---+",
+        "|",
+        "2",
+        "|",
+        "+---+",
+    ]
+    assert "loaded" in run.stderr
+
+
+def test_ip_command(tmp_path):
+    with open(tmp_path / "t.json", "w") as f:
+        json.dump({"aws_vpc": [{"id": "vpc-1", "cidr_block": "10.0.0.0/16"}]}, f)
+    run = explorer(
+        "--json",
+        "t.json",
+        "-c",
+        ".ip",
+        "-c",
+        ".ip 10.0.1.5",
+        "-c",
+        ".ip 10'",
+        cwd=tmp_path,
+    )
+    assert "usage: .ip address" in run.stdout
+    assert "| aws_vpc  | cidr_block | vpc-1       | 10.0.0.0/16 |" in run.stdout
+    assert "OperationalError" in run.stdout
@@ -0,0 +1,38 @@
+import gzip
+import pytest
+from bench import legacy_flow_log
+from flowlog import read_flow_log
+
+HEADER = b"account-id srcaddr dstaddr bytes protocol\n"
+LINE = 26
+
+
+def flow_log(filename, length):
+    # a log of LINE byte lines whose body, after the header, runs up to
+    # LINE - 1 bytes past length
+    with gzip.open(filename, mode="wb") as f:
+        f.write(HEADER)
+        for i in range(0, length // LINE + 1):
+            f.write(
+                b"%d 10.0.%d.%d 10.0.0.2 %03d 6\n" % (i % 3, i % 10, i % 7, i % 999)
+            )
+
+
+def parsed_like_legacy(logfile, **kwargs):
+    table = read_flow_log(logfile, **kwargs)
+    return (table.key_bytes(), table.rows) == legacy_flow_log(logfile)
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 26, 60, 71, 72, 73, 100, 333, 4096])
+@pytest.mark.parametrize("blocks", [0, 1, 3])
+def test_block_boundary(tmp_path, block_size, blocks):
+    # the last block is shorter than a field window
+    logfile = str(tmp_path / "flow.log.gz")
+    flow_log(logfile, blocks * block_size)
+    assert parsed_like_legacy(logfile, block_size=block_size)
+
+
+def test_default_block_boundary(tmp_path):
+    logfile = str(tmp_path / "flow.log.gz")
+    flow_log(logfile, 1 << 24)
+    assert parsed_like_legacy(logfile)
@@ -0,0 +1,114 @@
+import gzip
+import os
+import sqlite3
+import subprocess
+import sys
+import pytest
+from bench import FLOW_LOG_HEADER, synthetic_flow_log
+
+FLOWPARSE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flowparse.py")
+FIELDS = "account,interface,src,dst"
+
+
+def flowparse(*argv, cwd, check=True):
+    return subprocess.run(
+        [sys.executable, FLOWPARSE, "--summary-fields", FIELDS, "--shards", "3"]
+        + ["--jobs", "2"]
+        + list(argv),
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=check,
+    )
+
+
+def write_log(filename, byte_counts):
+    # a flow log of the same flow, once per byte count
+    with gzip.open(filename, "wt") as f:
+        f.write(FLOW_LOG_HEADER + "\n")
+        for byte_count in byte_counts:
+            f.write(
+                f"2 123456789010 eni-zero 10.9.9.9 10.8.8.8 1234 443 6 1 {byte_count} "
+                "1600000000 1600000060 ACCEPT OK\n"
+            )
+
+
+def flows(sqlite_file):
+    db = sqlite3.connect(sqlite_file)
+    rows = db.execute("select * from flow;").fetchall()
+    db.close()
+    return sorted(rows, key=repr)
+
+
+def fresh(tmp_path, int_ips):
+    # the same logs summed from scratch, caches and all
+    for name in ["fresh.db", "fresh.db-wal", "fresh.db-shm"]:
+        if os.path.exists(tmp_path / name):
+            os.remove(tmp_path / name)
+    flowparse(
+        "logs",
+        "--flowcache",
+        "fresh_cache",
+        "--sqlite-file",
+        "fresh.db",
+        *int_ips,
+        cwd=tmp_path,
+    )
+    return flows(tmp_path / "fresh.db")
+
+
+@pytest.mark.parametrize("int_ips", [[], ["--int-ips"]])
+def test_incremental_matches_fresh(tmp_path, int_ips):
+    os.makedirs(tmp_path / "logs" / "a")
+    os.makedirs(tmp_path / "logs" / "b")
+    synthetic_flow_log(tmp_path / "logs" / "a" / "1.gz", 2000, seed=1)
+    synthetic_flow_log(tmp_path / "logs" / "a" / "2.gz", 2000, seed=2)
+    # a flow of no bytes, and the same flow with bytes in a log that goes
+    write_log(tmp_path / "logs" / "b" / "zero.gz", [0])
+    write_log(tmp_path / "logs" / "b" / "some.gz", [500, 0])
+
+    def incremental(*argv, check=True):
+        return flowparse(
+            "logs",
+            "--flowcache",
+            "cache",
+            "--sqlite-file",
+            "inc.db",
+            *int_ips,
+            *argv,
+            cwd=tmp_path,
+            check=check,
+        )
+
+    incremental()
+    assert flows(tmp_path / "inc.db") == fresh(tmp_path, int_ips)
+
+    # a new log
+    synthetic_flow_log(tmp_path / "logs" / "a" / "3.gz", 2000, seed=3)
+    incremental()
+    assert flows(tmp_path / "inc.db") == fresh(tmp_path, int_ips)
+
+    # a changed log
+    synthetic_flow_log(tmp_path / "logs" / "a" / "3.gz", 1500, seed=4)
+    os.utime(tmp_path / "logs" / "a" / "3.gz", (1, 1))
+    incremental()
+    assert flows(tmp_path / "inc.db") == fresh(tmp_path, int_ips)
+
+    # a missing log fails and changes nothing unless it's subtracted; the
+    # zero byte flow stays, with only its own log's bytes
+    os.remove(tmp_path / "logs" / "b" / "some.gz")
+    before = flows(tmp_path / "inc.db")
+    assert incremental(check=False).returncode != 0
+    assert flows(tmp_path / "inc.db") == before
+    incremental("--missing", "subtract")
+    after = flows(tmp_path / "inc.db")
+    assert after == fresh(tmp_path, int_ips)
+    assert len(after) == len(before)
+    assert [row[-1] for row in before if "eni-zero" in row] == [500]
+    assert [row[-1] for row in after if "eni-zero" in row] == [0]
+
+    # and goes when the last log it's in does
+    os.remove(tmp_path / "logs" / "b" / "zero.gz")
+    incremental("--missing", "subtract")
+    assert flows(tmp_path / "inc.db") == fresh(tmp_path, int_ips)
+    assert not [row for row in flows(tmp_path / "inc.db") if "eni-zero" in row]
@@ -0,0 +1,183 @@
+import json
+import os
+from tfdb import TerraformState
+
+
+def table_dump(tfs):
+    # every row of every loaded table, with the type each value is stored as
+    dump = {}
+    for tbl_name in sorted(tfs.types):
+        cols = sorted(tfs.types[tbl_name])
+        values = ",".join(f"{c}, typeof({c})" for c in cols)
+        rows = tfs.db.execute(f"select {values} from {tbl_name};").fetchall()
+        dump[tbl_name] = sorted(rows, key=repr)
+    return dump
+
+
+def fresh_load(inputs):
+    tfs = TerraformState()
+    with tfs.bulk():
+        for kind, filename in inputs:
+            tfs._add_input(kind, filename)
+    return tfs
+
+
+def write_json(filename, tables, mtime):
+    with open(filename, "w") as f:
+        json.dump(tables, f)
+    os.utime(filename, (mtime, mtime))
+
+
+def test_refresh_matches_fresh_load(tmp_path):
+    # typed columns: the boolean, integer and real strings are converted
+    # whichever way the rows are loaded
+    a, b = str(tmp_path / "a.json"), str(tmp_path / "b.json")
+    write_json(a, {"t": [{"ok": "true", "n": "1", "x": "1.5", "s": "a"}]}, 1)
+    write_json(b, {"t": [{"ok": "false", "n": "2", "x": "2.5", "s": "b"}]}, 1)
+    inputs = [("json", a), ("json", b)]
+    tfs = TerraformState()
+    assert tfs.refresh(inputs)
+    assert table_dump(tfs) == table_dump(fresh_load(inputs))
+    assert tfs.db.execute("select count(*) from t where ok;").fetchone() == (1,)
+
+    write_json(b, {"t": [{"ok": "true", "n": "3", "x": "3.5", "s": "c"}]}, 2)
+    assert tfs.refresh(inputs)
+    assert table_dump(tfs) == table_dump(fresh_load(inputs))
+    assert tfs.db.execute("select count(*) from t where ok;").fetchone() == (2,)
+
+
+def test_batched_state_load(tmp_path, monkeypatch):
+    # flushing every row, so duplicates replace rows already written, ends
+    # up as flushing once
+    import tfdb
+    from bench import synthetic_state_files
+
+    names = []
+    for idx, state in enumerate(synthetic_state_files(8, 30)):
+        names.append(str(tmp_path / f"{idx}.tfstate"))
+        with open(names[-1], "w") as f:
+            f.write(state)
+    dumps = []
+    for batch in [tfdb.TABLE_BATCH_ROWS, 1]:
+        monkeypatch.setattr(tfdb, "TABLE_BATCH_ROWS", batch)
+        tfs = TerraformState(child_tables=True)
+        tfs.add_state_files(names)
+        dumps.append(table_dump(tfs))
+    assert dumps[0] == dumps[1]
+
+
+def test_parallel_state_load_matches_serial(tmp_path, monkeypatch):
+    # resource ids repeat across files, so which duplicate is kept depends
+    # on the order files are added in; rows are compared in rowid order
+    import tfdb
+    from bench import synthetic_state_files
+
+    names = []
+    for idx, state in enumerate(synthetic_state_files(12, 40, extra_attributes=2)):
+        names.append(str(tmp_path / f"{idx}.tfstate"))
+        with open(names[-1], "w") as f:
+            f.write(state)
+    monkeypatch.setattr(tfdb, "TABLE_BATCH_ROWS", 50)
+    dumps = []
+    for jobs in [1, 3]:
+        tfs = TerraformState(child_tables=True)
+        tfs.add_state_files(names, jobs=jobs)
+        dumps.append(
+            {
+                tbl_name: tfs.db.execute(
+                    f"select rowid, * from {tbl_name} order by rowid;"
+                ).fetchall()
+                for tbl_name in sorted(tfs.types)
+            }
+        )
+    assert dumps[0] == dumps[1]
+    assert sum(map(len, dumps[0].values())) > 0
+
+
+def test_index_advice(tmp_path):
+    # an empty value doesn't stop an IP column being indexed, and only the
+    # tables a load touched are sampled again
+    a, b = str(tmp_path / "a.json"), str(tmp_path / "b.json")
+    write_json(a, {"t": [{"public_ip": ""}, {"public_ip": "10.0.0.1"}]}, 1)
+    write_json(b, {"u": [{"private_ip": "10.0.0.2"}]}, 1)
+    tfs = TerraformState()
+    assert tfs.refresh([("json", a)])
+    assert tfs.refresh([("json", a), ("json", b)])
+    indexes = tfs.db.execute("select tbl_name, col_name from tf_indexes;").fetchall()
+    assert sorted(indexes) == [("t", "public_ip"), ("u", "private_ip")]
+    samples = []
+    tfs.db.set_trace_callback(samples.append)
+    write_json(b, {"u": [{"private_ip": "10.0.0.3"}]}, 2)
+    assert tfs.refresh([("json", a), ("json", b)])
+    assert not [s for s in samples if "select distinct" in s and " from t " in s]
+
+
+def test_cidr_index_once_per_block(tmp_path):
+    # with child tables a nested cidr_block is indexed from the child table
+    # only, including when another route's cidr_block is empty
+    from bench import synthetic_state
+
+    attributes = {
+        "id": "rtb-1",
+        "route.#": "2",
+        "route.0.cidr_block": "10.1.0.0/16",
+        "route.1.cidr_block": "",
+        "cidr_map.%": "1",
+        "cidr_map.cidr_block": "10.9.0.0/16",
+    }
+    resource = {
+        "type": "aws_route_table",
+        "primary": {"id": "rtb-1", "attributes": attributes},
+        "provider": "provider.aws",
+    }
+    name = str(tmp_path / "rt.tfstate")
+    with open(name, "w") as f:
+        json.dump(synthetic_state([resource]), f)
+    for child_tables in [False, True]:
+        tfs = TerraformState(child_tables=child_tables)
+        tfs.add_state_files([name])
+        cidrs = tfs.db.execute("select cidr from cidr_index order by cidr;").fetchall()
+        assert cidrs == [("10.1.0.0/16",), ("10.9.0.0/16",)]
+
+
+def test_values_outside_sample_stored_as_given():
+    # a JSON column has TEXT affinity, so a numeric looking value past the
+    # sample isn't turned into a number
+    tfs = TerraformState()
+    rows = [{"j": '{"a": 1}', "b": "true"}] * 1000 + [{"j": "0123", "b": "false"}]
+    tfs.add_dict_of_tables({"t": rows})
+    assert tfs.db.execute("select j, b from t where rowid = 1001;").fetchone() == (
+        "0123",
+        0,
+    )
+    assert tfs.db.execute("select count(*) from t where b;").fetchone() == (1000,)
+
+
+def test_attach_waits_for_load_transaction(tmp_path):
+    # a background load part way through a flush holds the lock with a
+    # transaction open, which ATTACH mustn't run inside
+    import sqlite3
+    import threading
+    import time
+
+    sqlite3.connect(tmp_path / "flow.db").close()
+    tfs = TerraformState()
+    tfs.add_dict_of_tables({"t": [{"a": "1"}]})
+    in_transaction = threading.Event()
+    committed = threading.Event()
+
+    def flush():
+        with tfs.lock:
+            tfs.db.execute("begin;")
+            tfs.db.execute("insert into t values ('2');")
+            in_transaction.set()
+            time.sleep(0.2)
+            tfs.db.commit()
+            committed.set()
+
+    thread = threading.Thread(target=flush)
+    thread.start()
+    in_transaction.wait()
+    tfs.add_database_file(str(tmp_path / "flow.db"), "flowdb")
+    assert committed.is_set()
+    thread.join()
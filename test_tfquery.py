@@ -0,0 +1,61 @@
+import sqlite3
+from tfquery import PAGE_SIZE, write_results
+
+
+def rows_db(rows):
+    db = sqlite3.connect(":memory:")
+    db.execute("create table t (a, b, c);")
+    db.executemany("insert into t values (?,?,?);", rows)
+    return db
+
+
+def written(tmp_path, db, sql, flags):
+    path = str(tmp_path / "out.txt")
+    count = write_results(db, sql, set(flags) | {f"out={path}"})
+    with open(path) as f:
+        return count, f.read().splitlines()
+
+
+def test_markdown_over_pages(tmp_path):
+    rows = [(i, "x" * (i % 7), None) for i in range(0, PAGE_SIZE * 2 + 5)]
+    count, lines = written(tmp_path, rows_db(rows), "select * from t;", ["md"])
+    assert count == len(rows)
+    # one heading and separator, then a line per row
+    assert len(lines) == len(rows) + 2
+    assert lines[0].split("|")[1].strip() == "a"
+    assert sum(line.startswith("|:") for line in lines) == 1
+
+
+def test_plain_over_pages(tmp_path):
+    # sized by the first page; a wider value on a later page starts a new
+    # heading rather than the query being run again to size the first
+    rows = [(i, "x", None) for i in range(0, PAGE_SIZE + 5)] + [(0, "y" * 8, None)]
+    db = rows_db(rows)
+    statements = []
+    db.set_trace_callback(statements.append)
+    count, lines = written(tmp_path, db, "select * from t;", [])
+    assert statements == ["select * from t;"]
+    assert count == len(rows)
+    assert len(lines) == len(rows) + 8
+    first, second = lines[: PAGE_SIZE + 4], lines[PAGE_SIZE + 4 :]
+    assert len({len(line) for line in first}) == 1
+    assert len({len(line) for line in second}) == 1
+    assert len(second[0]) > len(first[0])
+    assert second[1].split("|")[1:3] == [" a    ", " b        "]
+    assert lines[-2].split("|")[2].strip() == "y" * 8
+
+
+def test_collapse(tmp_path):
+    db = rows_db([(1, None, None)])
+    count, lines = written(tmp_path, db, "select * from t;", ["collapse"])
+    assert lines[1].split("|")[1:-1] == [" a "]
+    # no result set, and run once
+    assert (
+        written(tmp_path, db, "insert into t values (2, 2, 2);", ["collapse"])[0] == 0
+    )
+    assert db.execute("select count(*) from t;").fetchone() == (2,)
+    count, lines = written(
+        tmp_path, db, "insert into t values (3, 3, null) returning *;", ["collapse"]
+    )
+    assert count == 1 and lines[1].split("|")[1:-1] == [" a ", " b "]
+    assert db.execute("select count(*) from t;").fetchone() == (3,)
@@ -0,0 +1,34 @@
+import io
+import pytest
+import yaml
+from tfstream import yaml_table_rows
+
+ANCHORS = """
+defaults: &defaults
+  - &base {owner: ops, location: syd, cpus: 2}
+  - &big {cpus: 8, memory_gb: 16.0}
+hosts:
+  - name: a
+    <<: *base
+  - name: b
+    cpus: 4
+    <<: *base
+  - <<: [*big, *base]
+    name: c
+  - name: d
+    tags: &tags [web, prod]
+    also: *tags
+    <<: {location: mel}
+"""
+
+
+@pytest.mark.parametrize("c_parser", [True, False])
+def test_yaml_anchors_and_merges(c_parser, monkeypatch):
+    if not c_parser:
+        monkeypatch.delattr(yaml, "CSafeLoader", raising=False)
+    expected = [
+        (t_name, row)
+        for t_name, rows in yaml.safe_load(ANCHORS).items()
+        for row in rows
+    ]
+    assert list(yaml_table_rows(io.StringIO(ANCHORS))) == expected
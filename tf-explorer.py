@@ -1,18 +1,28 @@
+import time
+
+launch_start = time.time()
+
+# anything only some runs need is imported where it's used
 import argparse
+import collections
+import contextlib
 import pprint
-import atexit
 import os
-import json
 import sqlite3
-import prettytable
-import readline
-import ipaddress
-import glob
-import gzip
-import pickle
-import re
-import yaml
-from tfdb import TerraformState
+import sys
+from tfdb import TerraformState, open_snapshot
+from tfquery import (
+    Profile,
+    ResultCache,
+    is_read_only,
+    loop_queries,
+    output_path,
+    page_table,
+    query_plan,
+    run_query,
+    script_statements,
+    write_results,
+)
 
 arg_parser = argparse.ArgumentParser(description="Analyse terraform state")
 arg_parser.add_argument("state", nargs="*")
@@ -21,53 +31,130 @@ arg_parser.add_argument("--yaml", type=argparse.FileType("r"), nargs="*")
 arg_parser.add_argument("--sqlite", nargs="*")
 arg_parser.add_argument("--flowsummary", nargs="*")
 arg_parser.add_argument("--flowdb", nargs="?")
+arg_parser.add_argument(
+    "--snapshot", nargs="?", help="on-disk cache, only changed inputs are reloaded"
+)
+arg_parser.add_argument(
+    "--jobs", type=int, default=1, help="state file parser processes, 0 for all cores"
+)
+arg_parser.add_argument(
+    "--no-indexes", action="store_true", help="don't index tables after loading"
+)
+arg_parser.add_argument(
+    "--no-cidr-index", action="store_true", help="don't build the cidr_index R*Tree"
+)
+arg_parser.add_argument(
+    "--no-ip-owner", action="store_true", help="don't build the ip_owner table"
+)
+arg_parser.add_argument(
+    "--child-tables",
+    action="store_true",
+    help="also load nested attributes into indexed {type}__{attribute} tables",
+)
+arg_parser.add_argument(
+    "--text-columns",
+    action="store_true",
+    help="store every attribute as text, instead of inferring column types",
+)
+arg_parser.add_argument(
+    "-c", action="append", metavar="SQL", help="run a query and exit, may be repeated"
+)
+arg_parser.add_argument("--script", help="run the queries in a file and exit")
+arg_parser.add_argument(
+    "--parallel",
+    type=int,
+    default=1,
+    help="run -c/--script queries on N read-only connections, one output file each",
+)
+arg_parser.add_argument(
+    "--out-dir", default=".", help="where --parallel writes query-NNN output files"
+)
+arg_parser.add_argument(
+    "--cache-mb", type=int, default=64, help="memory for cached query results"
+)
+arg_parser.add_argument(
+    "--no-cache", action="store_true", help="always run queries, never from cache"
+)
+arg_parser.add_argument(
+    "--foreground",
+    action="store_true",
+    help="load everything before the prompt, instead of in the background",
+)
 args = arg_parser.parse_args()
+import_time = time.time() - launch_start
 
 sqlite3.enable_callback_tracebacks(True)
 
 db = None
 if args.sqlite:
     assert len(args.sqlite) == 1
-    assert not args.state
-    #    assert not args.json
-    #    assert not args.json
-    assert not args.flowsummary
+    assert not args.snapshot
+    db = sqlite3.connect(args.sqlite[0], check_same_thread=False)
+elif args.snapshot:
+    db = open_snapshot(args.snapshot)
+
+tfs = TerraformState(
+    db=db,
+    auto_index=not args.no_indexes,
+    cidr_index=not args.no_cidr_index,
+    child_tables=args.child_tables,
+    typed=not args.text_columns,
+    ip_owner=not args.no_ip_owner,
+)
 
-    db = sqlite3.connect(args.sqlite[0])
+loader = None
+init_time = time.time() - import_time - launch_start
+pprint.pprint(("started", import_time, "imports", init_time, "init"), stream=sys.stderr)
 
-tfs = TerraformState(db=db)
+load_start = time.time()
+inputs = [("state", state_file_name) for state_file_name in args.state]
+inputs += [("json", json_file.name) for json_file in args.json or []]
+inputs += [("yaml", yaml_file.name) for yaml_file in args.yaml or []]
+inputs += [("flowsummary", filename) for filename in args.flowsummary or []]
+if args.snapshot:
+    if tfs.refresh(inputs, jobs=args.jobs or os.cpu_count()):
+        tfs.save_snapshot(args.snapshot)
+elif not (args.foreground or args.c or args.script):
+    from tfload import BackgroundLoader
 
-for state_file_name in args.state:
-    with open(state_file_name, "r") as state_file:
-        tfs.add_state_file(state_file)
+    loader = BackgroundLoader(tfs, inputs, jobs=args.jobs or os.cpu_count()).start()
+else:
+    with tfs.bulk():
+        tfs.add_state_files(args.state, jobs=args.jobs or os.cpu_count())
 
-if args.json is not None:
-    for json_file in args.json:
-        tfs.add_dict_of_tables(json.load(json_file))
+        if args.json is not None:
+            for json_file in args.json:
+                tfs.add_json_file(json_file.name)
 
-if args.yaml is not None:
-    for yaml_file in args.yaml:
-        tfs.add_dict_of_tables(yaml.safe_load(yaml_file))
+        if args.yaml is not None:
+            for yaml_file in args.yaml:
+                tfs.add_yaml_file(yaml_file.name)
 
-if args.flowsummary is not None:
-    for flowsummary_file in args.flowsummary:
-        tfs.add_flowsummary_file(flowsummary_file)
+        if args.flowsummary is not None:
+            for flowsummary_file in args.flowsummary:
+                tfs.add_flowsummary_file(flowsummary_file)
+load_time = time.time() - load_start
+if tfs.rows_loaded > 0 and loader is None:
+    pprint.pprint(
+        ("loaded", tfs.rows_loaded, "rows in", load_time, tfs.rows_loaded / load_time),
+        stream=sys.stderr,
+    )
 if args.flowdb is not None:
     tfs.add_database_file(args.flowdb, "flowdb")
 
 
-histfile = os.path.join(os.path.expanduser("~"), ".tf-explorer_history")
-try:
-    readline.read_history_file(histfile)
-    readline.set_history_length(1000)
-except FileNotFoundError:
-    pass
+slowlog = collections.deque(maxlen=100)  # (seconds, sql) of recent queries
+cache = None if args.no_cache else ResultCache(args.cache_mb << 20)
+
+
+# metacommands run_line carries out itself, rather than as a query
+LOCAL_FLAGS = {"loop", "status", "slowlog", "cache", "ip"}
 
-atexit.register(readline.write_history_file, histfile)
 
-while True:
-    line = input("> ")
+def parse_line(line):
+    # (flags, sql, metacommand words) for a line of input
     flags = set()
+    cmd = None
     while line.startswith("#") and " " in line:
         space = line.find(" ")
         flags.add(line[1:space])
@@ -92,86 +179,200 @@ select sql from sqlite_master where type='table' and name in
             sql = f"""  
 select * from schema where tbl_name in 
 ({','.join(map(lambda s: "'%s'" % s, cmd[1:]))});"""
+        elif cmd[0] == ".indexes":
+            flags.remove("no-format")
+            sql = "select * from tf_indexes;"
+        elif cmd[0] in (".status", ".slowlog", ".cache", ".ip"):
+            flags.add(cmd[0][1:])
         elif cmd[0] == ".loop":  # .loop query_table data_table
-            sql = f"""select * from {cmd[1]}"""
             flags.remove("no-format")
             flags.add("loop")
         else:
             sql = "select 'unknown command';"
+    return flags, sql, cmd
+
+
+def show_status():
+    import prettytable
+
+    if loader is None:
+        print("loaded")
+        return
+    if loader.done:
+        pprint.pprint(("loaded", tfs.rows_loaded, "rows in", loader.load_time))
+    else:
+        pprint.pprint(
+            (
+                "loading",
+                tfs.rows_loaded,
+                "rows so far",
+                time.time() - loader.start_time,
+            )
+        )
+    if loader.error is not None:
+        pprint.pprint(("loading failed", loader.error))
+    table = prettytable.PrettyTable()
+    table.field_names = ["table", "files loaded", "files", "rows", "state"]
+    table.add_rows(loader.status())
+    table.align = "l"
+    print(table)
 
-    cur = tfs.db.cursor()
+
+def show_slowlog():
+    # the slowest recent queries and their plans
+    with tfs.lock:
+        for how_long, slow_sql in sorted(slowlog, reverse=True)[:10]:
+            pprint.pprint((how_long, slow_sql))
+            try:
+                for plan_line in query_plan(tfs.db, slow_sql):
+                    print("    " + plan_line)
+            except sqlite3.Error as e:
+                pprint.pprint(e)
+
+
+def show_cache(cmd):
+    # .cache hit/miss stats, .cache clear empties it
+    if cache is None:
+        print("cache disabled")
+        return
+    if cmd[1:] == ["clear"]:
+        cache.clear()
+    for stat in cache.stats():
+        pprint.pprint(stat)
+
+
+def show_ip(cmd):
+    # .ip address: the networks in cidr_index containing it
+    if len(cmd) != 2:
+        print("usage: .ip address")
+        return
+    if loader is not None:
+        loader.wait_for("cidr_index")
     try:
-        cur.execute(sql)
-        if "no-format" in flags:
-            for i in cur.fetchall():
-                print(i[0])
-        elif "loop" in flags:
-            colmap = {}
-            for idx, i in enumerate(cur.description):
-                colmap[i[0]] = idx
-            queries = []
-            for row in cur.fetchall():
-                q = {}
-                for k, idx in colmap.items():
-                    q[k] = row[idx]
-                queries.append(q)
-            cur.execute(f""" select * from {cmd[2]}""")
-            colmap = {}
-            for idx, i in enumerate(cur.description):
-                colmap[i[0]] = idx
-            result_rows = []
-            for row_ in cur.fetchall():
-                row = {}
-                for k, idx in colmap.items():
-                    row[k] = row_[idx]
-                rowout = []
-                result_rows.append(rowout)
-                for q in queries:
-                    qtext = q["q"]
-                    params = []
-                    for p in range(0, 10):
-                        p_k = f"""p{p}"""
-                        if p_k in q and q[p_k] is not None:
-                            params.append(row[q[p_k]])
-                    cur.execute(qtext, params)
-                    result = cur.fetchone()
-                    if result is not None:
-                        result = result[0]
-                    rowout.append(str(result))
-                print(",".join(rowout))
-        else:
-            fields = []
-            for i in map(lambda z: z[0], cur.description):
-                if i not in fields:
-                    fields.append(i)
-                else:
-                    for j in range(1, 20):
-                        f_n = f"{i}_{j}"
-                        if f_n not in fields:
-                            fields.append(f_n)
-                            break
-
-            rows = cur.fetchall()
-            table = prettytable.PrettyTable()
+        with tfs.lock:
+            rows = tfs.containing(cmd[1])
+    except sqlite3.OperationalError as e:
+        pprint.pprint(e)
+        return
+    fields = ["tbl_name", "col_name", "resource_id", "cidr"]
+    print(page_table(fields, rows, set()))
 
-            table.field_names = fields
-            table.add_rows(rows)
-            if "collapse" in flags:  # hide all columns which are only NULL
-                not_nones = [False] * len(fields)
-                for i in range(0, len(fields)):
-                    for j in rows:
-                        if j[i] is not None:
-                            not_nones[i] = True
-                            break
 
-                for i in range(len(fields) - 1, -1, -1):
-                    if not not_nones[i]:
-                        table.del_column(fields[i])
+def run_line(line):
+    flags, sql, cmd = parse_line(line)
+    if "cache" in flags:
+        show_cache(cmd)
+        return
+    if "ip" in flags:
+        show_ip(cmd)
+        return
+    if "status" in flags:
+        show_status()
+        return
+    if "slowlog" in flags:
+        show_slowlog()
+        return
+    if loader is not None:
+        loader.wait_for(f"{line} {sql}")
+    profile = Profile() if "profile" in flags else None
+    tfs.lock.acquire()
+    try:
+        if "plan" in flags and "loop" not in flags:
+            for plan_line in query_plan(tfs.db, sql):
+                print(plan_line)
+        start = time.time()
+        with profile.attach(tfs.db) if profile else contextlib.nullcontext():
+            if "loop" in flags:
+                for timing in loop_queries(tfs.db, cmd[1], cmd[2], flags):
+                    pprint.pprint(timing)
+            else:
+                rows = write_results(tfs.db, sql, flags, cache, tfs.generation)
+                if not is_read_only(sql):
+                    tfs.generation += 1
+                if output_path(flags) is not None:
+                    pprint.pprint(("wrote", rows, "rows to", output_path(flags)))
+        how_long = time.time() - start
+        if cmd is None:
+            slowlog.append((how_long, sql))
+        if "time" in flags:
+            pprint.pprint(("time", how_long))
+        if profile is not None:
+            import prettytable
 
+            table = prettytable.PrettyTable()
+            table.field_names = ["function", "calls", "seconds"]
+            table.add_rows(profile.report())
             table.align = "l"
-            if "md" in flags:
-                table.set_style(prettytable.MARKDOWN)
             print(table)
-
-    except sqlite3.OperationalError as e:
+            pprint.pprint(("vm steps", profile.steps))
+    except (sqlite3.OperationalError, OSError) as e:
         pprint.pprint(e)
+    finally:
+        tfs.lock.release()
+
+
+def run_parallel(statements):
+    # SQL statements on --parallel read-only connections to a file-backed
+    # snapshot, each to its own output file; the rest (.loop, .status...)
+    # afterwards on this connection
+    import atexit
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+
+    if args.snapshot and os.path.exists(args.snapshot):
+        # what the database was loaded from or has just been saved to; a
+        # refresh that had nothing to load doesn't write one
+        snapshot = args.snapshot
+    else:
+        tmp = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, tmp)
+        snapshot = os.path.join(tmp, "tf-explorer.snapshot")
+        tfs.save_snapshot(snapshot)
+    jobs = []
+    serial = []
+    for idx, statement in enumerate(statements):
+        flags, sql, cmd = parse_line(statement)
+        if flags & LOCAL_FLAGS:
+            serial.append(statement)
+            continue
+        if output_path(flags) is None:
+            ext = "csv" if "csv" in flags else "jsonl" if "jsonl" in flags else "txt"
+            flags.add(f"out={os.path.join(args.out_dir, f'query-{idx + 1:03d}.{ext}')}")
+        jobs.append((snapshot, args.flowdb, sql, flags))
+    with Pool(args.parallel) as pool:
+        for sql, path, rows, how_long, error in pool.imap(run_query, jobs):
+            if error is not None:
+                pprint.pprint((sql, error))
+            else:
+                pprint.pprint(("wrote", rows, "rows to", path, how_long))
+    for statement in serial:
+        run_line(statement)
+
+
+statements = list(args.c or [])
+if args.script is not None:
+    with open(args.script, "r") as f:
+        statements += script_statements(f.read())
+
+if len(statements) > 0:
+    if args.parallel > 1:
+        run_parallel(statements)
+    else:
+        for statement in statements:
+            run_line(statement)
+else:
+    import atexit
+    import readline
+
+    histfile = os.path.join(os.path.expanduser("~"), ".tf-explorer_history")
+    try:
+        readline.read_history_file(histfile)
+        readline.set_history_length(1000)
+    except FileNotFoundError:
+        pass
+
+    atexit.register(readline.write_history_file, histfile)
+
+    while True:
+        run_line(input("> "))
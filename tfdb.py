@@ -1,51 +1,87 @@
-import argparse
-import pprint
-import atexit
+import contextlib
+import functools
 import os
 import json
 import sqlite3
-import prettytable
-import readline
-import ipaddress
-import glob
-import gzip
-import pickle
+import threading
 import re
-import yaml
+import time
+from tfflat import column_name
+from tfstream import json_table_rows, state_resources, yaml_table_rows
+
+
+@functools.lru_cache(maxsize=65536)
+def ip_int(ip_s):
+    # (version, integer) for an IP address
+    parts = ip_s.split(".")
+    if len(parts) == 4 and all(
+        p.isascii() and p.isdigit() and len(p) <= 3 and (p == "0" or p[0] != "0")
+        for p in parts
+    ):
+        a, b, c, d = map(int, parts)
+        if a < 256 and b < 256 and c < 256 and d < 256:
+            return 4, (a << 24) | (b << 16) | (c << 8) | d
+    import ipaddress
+
+    ip = ipaddress.ip_address(ip_s)
+    return ip.version, int(ip)
+
+
+@functools.lru_cache(maxsize=65536)
+def ip_bounds(ip_range_s):
+    # (version, first, last) as integers for "a.b.c.d/n", "a-b" or an address
+    import ipaddress
+
+    if "-" in ip_range_s:
+        r0, r1 = map(ipaddress.ip_address, ip_range_s.split("-"))
+        return r0.version, int(r0), int(r1)
+    elif "/" in ip_range_s:
+        network = ipaddress.ip_network(ip_range_s)
+        return (
+            network.version,
+            int(network.network_address),
+            int(network.broadcast_address),
+        )
+    version, i = ip_int(ip_range_s)
+    return version, i, i
 
 
 def ip_within_sql(needle, haystack):
     if needle is None or haystack is None:
         return False
-    needle = ipaddress.ip_address(needle)
-    if "-" in haystack:
-        r0, r1 = map(ipaddress.ip_address, haystack.split("-"))
-        return needle >= r0 and needle <= r1
-    elif "/" in haystack:
-        haystack = ipaddress.ip_network(haystack)
-        return needle in haystack
-    else:
+    if "-" not in haystack and "/" not in haystack:
+        import pprint
+
         pprint.pprint(f"cannot parse network {haystack}")
         raise Exception(f"cannot parse network {haystack}")
+    version, i = ip_int(needle)
+    h_version, first, last = ip_bounds(haystack)
+    return version == h_version and first <= i <= last
 
 
 def ip_sortable_sql(ip_range_s):
     if ip_range_s is None:
         return False
-    ip_address = None
     if "/" in ip_range_s:
-        ip_range = ipaddress.ip_network(ip_range_s)
-        ip_address = ip_range.network_address
+        version, i, _ = ip_bounds(ip_range_s)
     else:
-        ip_address = ipaddress.ip_address(ip_range_s)
-
-    return "{:#x}".format(ip_address)
+        version, i = ip_int(ip_range_s)
+    if version == 4:
+        return "0x%08x" % i
+    return "0x%032x" % i
 
 
 def ip_truncate_sql(addr_as_text, bits):
-    addr = ipaddress.ip_address(addr_as_text)
-    addr_b = bytearray(addr.packed)
+    version, i = ip_int(addr_as_text)
     assert bits % 8 == 0
+    if version == 4:
+        # the first octet is always kept
+        bits = min(max(bits, 8), 32)
+        i &= (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+        return "%d.%d.%d.%d" % (i >> 24, (i >> 16) & 255, (i >> 8) & 255, i & 255)
+    import ipaddress
+
+    addr_b = bytearray(ipaddress.ip_address(addr_as_text).packed)
     if bits <= 24:
         addr_b[3] = 0
     if bits <= 16:
@@ -55,6 +91,28 @@ def ip_truncate_sql(addr_as_text, bits):
     return str(ipaddress.ip_address(bytes(addr_b)))
 
 
+def ip_to_int_sql(ip_s):
+    # IPv4 only, SQLite integers can't hold an IPv6 address
+    if ip_s is None:
+        return None
+    version, i = ip_int(ip_s)
+    return i if version == 4 else None
+
+
+def cidr_start_sql(ip_range_s):
+    if ip_range_s is None:
+        return None
+    version, first, last = ip_bounds(ip_range_s)
+    return first if version == 4 else None
+
+
+def cidr_end_sql(ip_range_s):
+    if ip_range_s is None:
+        return None
+    version, first, last = ip_bounds(ip_range_s)
+    return last if version == 4 else None
+
+
 def aws_account_sql(arn):
     return arn_field_sql(arn, 4)
 
@@ -68,7 +126,187 @@ def arn_field_sql(arn, fieldno):
     return parts[fieldno]
 
 
+def ip_key_sql(ip_s):
+    # an IPv4 address as a signed 32 bit integer, the key used by cidr_index
+    if ip_s is None:
+        return None
+    version, i = ip_int(ip_s)
+    return i - (1 << 31) if version == 4 else None
+
+
+def ipv4_network_bounds(v):
+    if not isinstance(v, str) or "/" not in v:
+        return None
+    try:
+        version, first, last = ip_bounds(v)
+    except ValueError:
+        return None
+    if version != 4:
+        return None
+    return first - (1 << 31), last - (1 << 31)
+
+
+INTEGER_RE = re.compile(r"-?(0|[1-9][0-9]{0,18})")
+REAL_RE = re.compile(r"-?(0|[1-9][0-9]*)\.[0-9]+")
+
+
+def is_integer(v):
+    if isinstance(v, bool):
+        return False
+    if isinstance(v, str) and INTEGER_RE.fullmatch(v):
+        v = int(v)
+    return isinstance(v, int) and -(1 << 63) <= v < (1 << 63)
+
+
+def is_real(v):
+    if isinstance(v, float) or is_integer(v):
+        return True
+    # only where the text survives the round trip through a double
+    return isinstance(v, str) and REAL_RE.fullmatch(v) and repr(float(v)) == v
+
+
+def is_boolean(v):
+    return isinstance(v, bool) or v in ("true", "false")
+
+
+def is_json(v):
+    return isinstance(v, str) and v[:1] in ("[", "{")
+
+
+def infer_type(col, values):
+    # declared type for a column from a sample of its values; ids stay text
+    # even when they look like numbers (account ids can start with a 0)
+    values = [v for v in values if v is not None and v != ""]
+    if len(values) == 0 or col == "id" or col.endswith(("_id", "_ids")):
+        return "TEXT"
+    # SQLite takes a column's affinity from its declared type: JSON has to
+    # be declared TEXT and booleans INTEGER, or NUMERIC affinity turns a
+    # later "0123" into 123; the names say how to convert after a reload
+    for col_type, test in [
+        ("INTEGER", is_integer),
+        ("BOOLEAN INTEGER", is_boolean),
+        ("REAL", is_real),
+        ("JSON TEXT", is_json),
+    ]:
+        if all(map(test, values)):
+            return col_type
+    return "TEXT"
+
+
+def to_integer(v):
+    return int(v) if is_integer(v) else v
+
+
+def to_real(v):
+    return float(v) if is_real(v) else v
+
+
+def to_boolean(v):
+    if isinstance(v, bool):
+        return int(v)
+    return {"true": 1, "false": 0}.get(v, v)
+
+
+TYPE_CONVERTERS = {
+    "INTEGER": to_integer,
+    "REAL": to_real,
+    "BOOLEAN INTEGER": to_boolean,
+}
+
+# rows a bulk load buffers before a flush, so big inputs load in bounded memory
+TABLE_BATCH_ROWS = 50000
+
+
+# (name, number of arguments, function, deterministic)
+SQL_FUNCTIONS = [
+    ("ip_within", 2, ip_within_sql, True),
+    ("ip_sortable", 1, ip_sortable_sql, True),
+    ("ip_truncate", 2, ip_truncate_sql, True),
+    ("ip_to_int", 1, ip_to_int_sql, True),
+    ("cidr_start", 1, cidr_start_sql, True),
+    ("cidr_end", 1, cidr_end_sql, True),
+    ("ip_key", 1, ip_key_sql, True),
+    ("aws_account", 1, aws_account_sql, False),
+    ("arn_field", 2, arn_field_sql, False),
+]
+
+
+def register_functions(db, wrap=None):
+    # the extra SQL functions, on any connection; wrap(name, fn) can replace
+    # each one, e.g. to count calls
+    for name, nargs, fn, deterministic in SQL_FUNCTIONS:
+        if wrap is not None:
+            fn = wrap(name, fn)
+        db.create_function(name, nargs, fn, deterministic=deterministic)
+
+
+# (table, address columns, (JSON list column, path to the address in each
+# element, None when the elements are addresses))
+# in order of precedence when more than one resource has the same address
+IP_OWNERS = [
+    ("aws_instance", ["private_ip", "public_ip"], []),
+    ("aws_nat_gateway", ["private_ip", "public_ip"], []),
+    ("aws_lb", [], [("subnet_mapping", "$.private_ipv4_address")]),
+    ("aws_alb", [], [("subnet_mapping", "$.private_ipv4_address")]),
+    ("aws_eip", ["private_ip", "public_ip"], []),
+    (
+        "aws_network_interface",
+        ["private_ip"],
+        [("private_ips", None), ("private_ip_list", None)],
+    ),
+]
+
+
+def child_value(v):
+    if isinstance(v, (dict, list)):
+        return json.dumps(v)
+    return v
+
+
+def child_rows(child, id, nested, idx=None):
+    # (table, row) for a nested attribute: maps become (id, key, value) rows,
+    # lists (id, idx, value) or, for lists of objects, (id, idx, <keys>...)
+    # with their own nested values one level further down, e.g.
+    # aws_security_group__ingress__cidr_blocks (id, idx, value)
+    key = {"id": id} if idx is None else {"id": id, "idx": idx}
+    if isinstance(nested, dict):
+        for k, v in nested.items():
+            if k != "%":
+                yield child, dict(key, key=k, value=child_value(v))
+    elif isinstance(nested, list):
+        for i, element in enumerate(nested):
+            if idx is None and isinstance(element, dict):
+                row = dict(key, idx=i)
+                for k, v in element.items():
+                    if k == "%":
+                        continue
+                    col = column_name(k)
+                    if col in ("id", "idx"):
+                        col = "_" + col
+                    row[col] = child_value(v)
+                    if isinstance(v, (dict, list)):
+                        yield from child_rows(f"{child}__{col}", id, v, i)
+                yield child, row
+            elif idx is None:
+                yield child, dict(key, idx=i, value=child_value(element))
+            else:
+                yield child, dict(key, value=child_value(element))
+
+
+def is_ip_address(v):
+    import ipaddress
+
+    try:
+        ipaddress.ip_address(str(v))
+    except ValueError:
+        return False
+    return True
+
+
 def flowcache_rows(filename):
+    import gzip
+    import pickle
+
     with gzip.open(filename, mode="rb") as f:
         flow_keys = pickle.load(f)
         while True:
@@ -83,172 +321,732 @@ def flowcache_rows(filename):
                 break
 
 
+def state_file_rows(state_file):
+    for rtype, r in state_resources(state_file):
+        assert "id" in r
+        yield rtype, r
+
+
+def state_file_name_rows(state_file_name):
+    # (rtype, row) pairs of a state file, read as they're wanted
+    with open(state_file_name, "r") as state_file:
+        yield from state_file_rows(state_file)
+
+
+def parse_state_file(state_file_name):
+    # worker side of a parallel load: parse one file into ready-to-insert
+    # rows, as a list to send back
+    return list(state_file_name_rows(state_file_name))
+
+
 class TerraformState:
-    def __init__(self, db=None):
+    def __init__(
+        self,
+        db=None,
+        bulk=True,
+        auto_index=True,
+        cidr_index=True,
+        child_tables=False,
+        typed=True,
+        ip_owner=True,
+    ):
         if db is None:
-            self.db = sqlite3.connect(":memory:")
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
         else:
             self.db = db
-        self.db.create_function("ip_within", 2, ip_within_sql)
-        self.db.create_function("ip_sortable", 1, ip_sortable_sql)
-        self.db.create_function("ip_truncate", 2, ip_truncate_sql)
-        self.db.create_function("aws_account", 1, aws_account_sql)
-        self.db.create_function("arn_field", 2, arn_field_sql)
+        # held while writing, so another thread can query between flushes
+        self.lock = threading.RLock()
+        register_functions(self.db)
         self.cur = self.db.cursor()
         self.types = dict()
         self.ids = set()
-        if db is None:
-            self._exec("create table schema (tbl_name, col_name);")
+        self.pending = dict()
+        self.pending_rows = 0
+        self.pending_ids = dict()
+        self.resource_types = set()
+        self.completeness = dict()
+        self.bulk_depth = 0
+        self.bulk_enabled = bulk
+        self.rows_loaded = 0
+        self.source = None
+        self.track_sources = False
+        self.pending_runs = dict()
+        self.pending_resources = []
+        self.changed_tables = set()
+        self.auto_index = auto_index
+        self.cidr_index = cidr_index
+        self.child_tables = child_tables
+        self.typed = typed
+        self.ip_owner = ip_owner
+        self.col_types = dict()
+        # bumped on every change, so cached query results can tell they're
+        # stale
+        self.generation = 0
+        self._exec("create table if not exists schema (tbl_name, col_name);")
+        for tbl_name, col_name in self.db.execute("select * from schema;"):
+            self.types.setdefault(tbl_name, set()).add(col_name)
+        for tbl_name in self.types:
+            self.col_types[tbl_name] = {
+                col[1]: col[2]
+                for col in self.db.execute(f"pragma table_info({tbl_name});")
+            }
+        for (name,) in self.db.execute(
+            "select name from sqlite_master where type = 'index' and sql like 'create unique index%';"
+        ):
+            if name.endswith("__id") and name[:-4] in self.types:
+                self.resource_types.add(name[:-4])
 
     def _exec(self, statement, *params):
         try:
             self.db.execute(statement, *params)
         except:
+            import pprint
+
             pprint.pprint([statement, params])
             raise
+        self.generation += 1
+        if self.bulk_depth == 0:
+            self.db.commit()
+
+    @contextlib.contextmanager
+    def bulk(self):
+        # buffer rows per table, write them all in one transaction on exit
+        if not self.bulk_enabled:
+            yield self
+            with self.lock:
+                self.after_load()
+            return
+        self.bulk_depth += 1
+        try:
+            yield self
+        finally:
+            self.bulk_depth -= 1
+            if self.bulk_depth == 0:
+                with self.lock:
+                    self.flush()
+        with self.lock:
+            self.after_load()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            if self.db.in_transaction:
+                self.db.commit()
+                self.generation += 1
+            return
+        pending, self.pending = self.pending, dict()
+        self.pending_rows = 0
+        self.pending_ids = dict()
+        runs, self.pending_runs = self.pending_runs, dict()
+        resources, self.pending_resources = self.pending_resources, []
+        self.bulk_depth += 1
+        try:
+            if not self.db.in_transaction:
+                self.db.execute("begin;")
+            for rtype, rows in pending.items():
+                rows = [r for r in rows if r is not None]
+                if len(rows) == 0:
+                    continue
+                cols = self._settle_columns(rtype, rows)
+                if rtype in runs:
+                    self._insert_tracked(rtype, cols, rows, runs[rtype])
+                else:
+                    self.db.executemany(
+                        f"""{self._insert_verb(rtype)} into {rtype}
+        ({','.join(cols)})
+        values ({','.join('?' * len(cols))});""",
+                        self._row_values(rtype, cols, rows),
+                    )
+                self.rows_loaded += len(rows)
+                self.changed_tables.add(rtype)
+                if self.child_tables and rtype in self.resource_types:
+                    self._write_child_rows(rtype, rows)
+            if len(resources) > 0:
+                self.db.executemany(
+                    "insert into tf_resources values (?,?,?);", resources
+                )
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            self.bulk_depth -= 1
+            self.generation += 1
+
+    def _settle_columns(self, rtype, rows):
+        cols = set()
+        for r in rows:
+            cols.update(r.keys())
+        if rtype not in self.types:
+            self._create_type(rtype, cols, rows)
+            self.types[rtype] = cols
+        elif not (cols <= self.types[rtype]):
+            self._add_columns(rtype, sorted(cols - self.types[rtype]), rows)
+            self.types[rtype].update(cols)
+        return sorted(cols)
+
+    def _row_values(self, rtype, cols, rows):
+        # values converted once, at load time, to each column's declared type
+        col_types = self.col_types.get(rtype, {})
+        converters = [TYPE_CONVERTERS.get(col_types.get(c)) for c in cols]
+        if not any(converters):
+            return ([r.get(c) for c in cols] for r in rows)
+        return (
+            [
+                v if convert is None or v is None else convert(v)
+                for convert, v in zip(converters, (r.get(c) for c in cols))
+            ]
+            for r in rows
+        )
+
+    def _infer_types(self, rtype, cols, rows):
+        col_types = self.col_types.setdefault(rtype, {})
+        for col in cols:
+            if not self.typed:
+                col_types[col] = ""
+                continue
+            sample = [r[col] for r in rows[:1000] if col in r]
+            col_types[col] = infer_type(col, sample)
+        return [f"{col} {col_types[col]}".rstrip() for col in cols]
+
+    def _delete_child_rows(self, rtype, ids):
+        for child in sorted(self.types):
+            if child.startswith(rtype + "__"):
+                self.db.executemany(f"delete from {child} where id=?;", ids)
+
+    def _write_child_rows(self, rtype, rows):
+        # replaced resources take their old child rows with them
+        self._delete_child_rows(rtype, [(r["id"],) for r in rows])
+        children = {}
+        for r in rows:
+            for col, v in r.items():
+                if not isinstance(v, str) or v[:1] not in ("[", "{"):
+                    continue
+                try:
+                    nested = json.loads(v)
+                except ValueError:
+                    continue
+                for child, child_row in child_rows(f"{rtype}__{col}", r["id"], nested):
+                    children.setdefault(child, []).append(child_row)
+        for child, child_rows_ in children.items():
+            created = child not in self.types
+            cols = self._settle_columns(child, child_rows_)
+            if created:
+                self._exec(f"create index {child}__id on {child} (id);")
+            if "value" in cols:
+                self._exec(
+                    f"create index if not exists {child}__value on {child} (value);"
+                )
+            if "key" in cols:
+                self._exec(
+                    f"create index if not exists {child}__key on {child} (key, value);"
+                )
+            self.db.executemany(
+                f"""insert into {child}
+        ({','.join(cols)})
+        values ({','.join('?' * len(cols))});""",
+                self._row_values(child, cols, child_rows_),
+            )
+            self.changed_tables.add(child)
+
+    def after_load(self):
+        if self.bulk_depth > 0 or len(self.changed_tables) == 0:
+            return
+        changed_tables, self.changed_tables = self.changed_tables, set()
+        self.generation += 1
+        if self.auto_index:
+            self._build_indexes(changed_tables)
+        if self.cidr_index:
+            self._build_cidr_index()
+        if self.ip_owner and changed_tables & {tbl for tbl, _, _ in IP_OWNERS}:
+            self._build_ip_owner()
+
+    def _build_indexes(self, changed_tables):
+        # index id, arn, *_id columns which hold another table's ids and
+        # columns of IP addresses; each index built is logged in tf_indexes
+        self._exec(
+            "create table if not exists tf_indexes (tbl_name, col_name, reason, seconds);"
+        )
+        indexed = set()
+        for tbl_name, name in self.db.execute(
+            "select tbl_name, name from sqlite_master where type = 'index';"
+        ):
+            if name.startswith(tbl_name + "__"):
+                indexed.add((tbl_name, name[len(tbl_name) + 2 :]))
+        candidates = []
+        # only tables this load touched can have new columns or values
+        for tbl_name in sorted(changed_tables & set(self.types)):
+            for col in sorted(self.types[tbl_name]):
+                if (tbl_name, col) in indexed:
+                    continue
+                elif col in ["id", "arn"]:
+                    candidates.insert(0, (tbl_name, col, col))
+                elif col.endswith("_id"):
+                    candidates.append((tbl_name, col, "references"))
+                else:
+                    candidates.append((tbl_name, col, "ip"))
+        for tbl_name, col, reason in candidates:
+            sample = [
+                v
+                for (v,) in self.db.execute(
+                    f"select distinct {col} from {tbl_name} where {col} is not null and {col} != '' limit 100;"
+                )
+            ]
+            if len(sample) == 0:
+                continue
+            if reason == "references":
+                reason = self._referenced_table(tbl_name, sample)
+                if reason is None:
+                    continue
+            elif reason == "ip" and not all(map(is_ip_address, sample[:20])):
+                continue
+            start = time.time()
+            self._exec(
+                f"create index if not exists {tbl_name}__{col} on {tbl_name} ({col});"
+            )
+            self._exec(
+                "insert into tf_indexes values (?,?,?,?);",
+                (tbl_name, col, reason, time.time() - start),
+            )
+
+    def _referenced_table(self, tbl_name, sample):
+        for other in sorted(self.types):
+            if other == tbl_name or "id" not in self.types[other]:
+                continue
+            found = self.db.execute(
+                f"select 1 from {other} where id in ({','.join('?' * len(sample))}) limit 1;",
+                sample,
+            ).fetchone()
+            if found is not None:
+                return f"references {other}.id"
+        return None
+
+    def _build_cidr_index(self):
+        # R*Tree over every IPv4 CIDR column (and cidr_block values nested in
+        # JSON columns, like route table routes), keyed by ip_key(), so
+        # finding the networks an address is in doesn't scan every table
+        self._exec("drop table if exists cidr_index;")
+        self._exec("""create virtual table cidr_index using rtree_i32
+            (id, first, last, +tbl_name, +col_name, +resource_id, +cidr);""")
+        entries = []
+        for tbl_name in sorted(self.types):
+            key = "id" if "id" in self.types[tbl_name] else "rowid"
+            for col in sorted(self.types[tbl_name]):
+                sample = [
+                    v
+                    for (v,) in self.db.execute(
+                        f"select {col} from {tbl_name} where {col} is not null and {col} != '' limit 20;"
+                    )
+                ]
+                if len(sample) == 0:
+                    continue
+                queries = []
+                if all(map(ipv4_network_bounds, sample)):
+                    queries.append(
+                        f"select {key}, '{col}', {col} from {tbl_name} where {col} is not null;"
+                    )
+                elif col == "value" and "key" in self.types[tbl_name]:
+                    # map attributes in a child table: (id, key, value) rows
+                    queries.append(
+                        f"select {key}, 'value', value from {tbl_name} where key = 'cidr_block';"
+                    )
+                # nested values with a child table of their own are indexed
+                # from that table, not again from the JSON here
+                if f"{tbl_name}__{col}" not in self.types and any(
+                    isinstance(v, str) and '"cidr_block"' in v for v in sample
+                ):
+                    queries.append(
+                        f"""select t.{key}, '{col}' || substr(j.path, 2) || '.' || j.key, j.value
+                        from {tbl_name} as t, json_tree(t.{col}) as j
+                        where json_valid(t.{col}) and j.key = 'cidr_block'
+                        and j.type = 'text';"""
+                    )
+                for query in queries:
+                    for resource_id, col_name, cidr in self.db.execute(
+                        query
+                    ).fetchall():
+                        bounds = ipv4_network_bounds(cidr)
+                        if bounds is not None:
+                            entries.append(
+                                bounds + (tbl_name, col_name, resource_id, cidr)
+                            )
+        self.db.executemany(
+            "insert into cidr_index (first, last, tbl_name, col_name, resource_id, cidr) values (?,?,?,?,?,?);",
+            entries,
+        )
         self.db.commit()
 
+    def _build_ip_owner(self):
+        # one row per address held by an instance, NAT gateway, load
+        # balancer, EIP or ENI (including secondary addresses), so flow
+        # logs join on ip = ip_owner.ip rather than an OR over columns
+        self.db.execute("drop table if exists ip_owner;")
+        self.db.execute("""create table ip_owner
+            (ip TEXT primary key, resource_type TEXT, resource_id TEXT, name TEXT);""")
+        for tbl_name, ip_cols, json_cols in IP_OWNERS:
+            cols = self.types.get(tbl_name, set())
+            if "id" not in cols:
+                continue
+            name = "null"
+            if "tags" in cols:
+                name = "case when json_valid(t.tags) then json_extract(t.tags, '$.Name') end"
+            if "name" in cols:
+                name = f"coalesce({name}, t.name)"
+            selects = [
+                f"select t.{col} as ip, t.id as id, {name} as name from {tbl_name} as t"
+                for col in ip_cols
+                if col in cols
+            ]
+            for col, path in json_cols:
+                if col not in cols:
+                    continue
+                ip = "j.value"
+                if path is not None:
+                    ip = f"json_extract(j.value, '{path}')"
+                selects.append(f"""select {ip} as ip, t.id as id, {name} as name
+                    from {tbl_name} as t,
+                    json_each(case when json_valid(t.{col}) then t.{col} end) as j""")
+            for select in selects:
+                self.db.execute(f"""insert or ignore into ip_owner
+                    select ip, '{tbl_name}', id, name from ({select})
+                    where ip is not null and ip != '';""")
+        self.db.commit()
+
+    def containing(self, ip):
+        # (tbl_name, col_name, resource_id, cidr) for every indexed network
+        # containing ip, most specific first
+        return self.db.execute(
+            """select tbl_name, col_name, resource_id, cidr from cidr_index
+            where first <= ip_key(?) and last >= ip_key(?) order by last - first;""",
+            (ip, ip),
+        ).fetchall()
+
+    def _insert_tracked(self, rtype, cols, rows, runs):
+        # explicit rowids, so each source file owns a contiguous rowid range
+        (base,) = self.db.execute(
+            f"select coalesce(max(rowid), 0) from {rtype};"
+        ).fetchone()
+        self.db.executemany(
+            f"""insert into {rtype}
+        (rowid,{','.join(cols)})
+        values (?,{','.join('?' * len(cols))});""",
+            (
+                [base + idx + 1] + values
+                for idx, values in enumerate(self._row_values(rtype, cols, rows))
+            ),
+        )
+        ends = [start for _, start in runs[1:]] + [len(rows)]
+        self.db.executemany(
+            "insert into tf_rowids values (?,?,?,?);",
+            (
+                (source, rtype, base + start + 1, base + end)
+                for (source, start), end in zip(runs, ends)
+            ),
+        )
+
+    def _insert_verb(self, rtype):
+        if rtype in self.resource_types:
+            return "insert or replace"  # unique id index replaces the old row
+        return "insert"
+
+    def _completeness(self, rtype):
+        # id -> count of non-NULL values, for picking the better duplicate
+        if rtype in self.completeness:
+            return self.completeness[rtype]
+        known = {}
+        if rtype in self.types:
+            with self.lock:
+                self._create_id_index(rtype)
+                cols = sorted(self.types[rtype])
+                count = "+".join(f"({c} is not null)" for c in cols)
+                for id, n in self.db.execute(f"select id, {count} from {rtype};"):
+                    known[id] = n
+        self.completeness[rtype] = known
+        return known
+
+    def _create_id_index(self, rtype):
+        self._exec(f"create unique index if not exists {rtype}__id on {rtype} (id);")
+
+    def _drop_pending(self, rtype, id):
+        idx = self.pending_ids.get(rtype, {}).pop(id, None)
+        if idx is not None:
+            self.pending[rtype][idx] = None
+
     def _add(self, rtype, rdict):
+        if self.bulk_depth > 0:
+            rows = self.pending.setdefault(rtype, [])
+            if rtype in self.resource_types:
+                self.pending_ids.setdefault(rtype, {})[rdict["id"]] = len(rows)
+            elif self.source is not None:
+                runs = self.pending_runs.setdefault(rtype, [])
+                if len(runs) == 0 or runs[-1][0] != self.source:
+                    runs.append((self.source, len(rows)))
+            rows.append(rdict)
+            self.pending_rows += 1
+            return
         if rtype not in self.types:
-            self._create_type(rtype, rdict.keys())
+            self._create_type(rtype, rdict.keys(), [rdict])
             self.types[rtype] = set(rdict.keys())
         if not (rdict.keys() <= self.types[rtype]):
-            self._add_columns(rtype, list(rdict.keys() - self.types[rtype]))
+            self._add_columns(rtype, list(rdict.keys() - self.types[rtype]), [rdict])
             self.types[rtype].update(rdict.keys())
 
-        def sqlize_data(z):
-            if isinstance(z, str):
-                return
-
         self._exec(
-            f"""insert into {rtype}
+            f"""{self._insert_verb(rtype)} into {rtype}
         ({','.join(rdict.keys())})
         values ({','.join('?' * len(rdict))});""",
-            list(rdict.values()),
+            next(self._row_values(rtype, list(rdict.keys()), [rdict])),
         )
+        self.rows_loaded += 1
+        self.changed_tables.add(rtype)
+        if self.child_tables and rtype in self.resource_types:
+            self._write_child_rows(rtype, [rdict])
+            self.db.commit()
 
-    def _create_type(self, rtype, rkeys):
-        self._exec(f'create table {rtype} ({",".join(sorted(rkeys))});')
+    def _create_type(self, rtype, rkeys, rows=()):
+        col_defs = self._infer_types(rtype, sorted(rkeys), list(rows))
+        self._exec(f'create table {rtype} ({",".join(col_defs)});')
+        if rtype in self.resource_types:
+            self._create_id_index(rtype)
         for col in sorted(rkeys):
             self._exec("insert into schema values(?,?);", (rtype, col))
 
-    def _add_columns(self, rtype, cols):
-        for col in cols:
-            self._exec(f"alter table {rtype} add column {col};")
+    def _add_columns(self, rtype, cols, rows=()):
+        for col, col_def in zip(cols, self._infer_types(rtype, cols, list(rows))):
+            self._exec(f"alter table {rtype} add column {col_def};")
             self._exec("insert into schema values(?,?);", (rtype, col))
 
     def add_state_file(self, state_file):
-        tfstate = json.load(state_file)
-        assert len(tfstate["modules"]) == 1
-        f_resources = tfstate["modules"][0]["resources"]
-        for name, resource in f_resources.items():
-            # we want ID
-            id = resource["primary"]["id"]
-            rtype = resource["type"]
-            r = {}
-
-            class Pointer:
-                def __init__(self, p=None):
-                    self.p = p
-
-            ra = dict(resource["primary"]["attributes"])
-            arrays = Pointer({})
-            for k in list(sorted(ra.keys())):  # '#' < '0'
-                v = ra[k]
-                by_dots = k.split(".")
-                if len(by_dots) == 1:
-                    continue
-                del ra[k]  # remove arrays
-                arr_host = arrays
-                while len(by_dots) > 0:
-                    x = by_dots.pop(0)
-                    remaining = len(by_dots)
-                    if x == "#":
-                        assert arr_host.p is None
-                        assert remaining == 0
-                        arr_host.p = [Pointer() for i in range(0, int(v))]
-                        break
-                    # if remaining > 0:
-
-                    if type(arr_host.p) == type(None):
-                        # then host not an array, so must be hash time
-                        arr_host.p = {}
-
-                    if type(arr_host.p) == dict:
-                        if x not in arr_host.p:
-                            arr_host.p[x] = Pointer()
-                        arr_host = arr_host.p[x]
-                    elif type(arr_host.p) == list:
-                        arr_host = arr_host.p[int(x)]
-                    else:
-                        assert False
-
-                    if remaining == 0:
-                        arr_host.p = v
-            # depointerise
-            arrays_nop = {}
-
-            def depointerise(x):
-                if type(x) == Pointer:
-                    return depointerise(x.p)
-                elif type(x) == list:
-                    return [depointerise(i) for i in x]
-                elif type(x) == dict:
-                    return {k: depointerise(v) for k, v in x.items()}
-                return x
-
-            for k, v in depointerise(arrays).items():
-                ra[k] = json.dumps(v)
-
-            for k, v in ra.items():  # resource['primary']['attributes'].items():
-                if k[-2:] in [".%", ".#"]:
-                    continue
-                k = re.sub(r"[^0-9a-zA-Z]", "_", k).lower()
-                #                k = k.replace('.', '_').replace('-','_').replace(' ','_').replace(':','_').replace("\t", '_').replace("\xa0", '_')
-                r[k] = v
-
-            assert "id" in r
-            # dedupe
-            if rtype in self.types and "id" in r:
-                # get existing
-                self.cur.execute(f"select * from {rtype} where id=?;", (str(r["id"]),))
-                rows = self.cur.fetchall()
-                assert len(rows) < 2
-                if len(rows) == 1:
-                    # is this one better?
-                    old_r = {}
-                    new_r = {}
-                    for k in r.keys():
-                        old_r[k] = None
-                        new_r[k] = r[k]
-                    for idx, col_ in enumerate(self.cur.description):
-                        col = col_[0]
-                        old_r[col] = rows[0][idx]
-                        if col not in new_r:
-                            new_r[col] = None
-                    if old_r == new_r:
-                        continue
-                    old_data_count = sum(
-                        1 for _ in filter(lambda x: x is not None, old_r.values())
-                    )
-                    new_data_count = sum(
-                        1 for _ in filter(lambda x: x is not None, new_r.values())
+        with self.bulk():
+            self.add_state_rows(state_file_rows(state_file))
+
+    def add_state_files(self, state_file_names, jobs=1):
+        with self.bulk():
+            if jobs == 1:
+                for state_file_name in state_file_names:
+                    self.add_state_rows(
+                        state_file_name_rows(state_file_name), source=state_file_name
                     )
-                    if new_data_count < old_data_count:
-                        continue
-                    self.db.execute(f"delete from {rtype} where id=?;", (r["id"],))
-                    self.db.commit()
+                return
+            # workers parse, this process is the only writer; imap keeps
+            # the input order so dedupe matches a serial load
+            from multiprocessing import Pool
+
+            with Pool(jobs) as pool:
+                for state_file_name, rows in zip(
+                    state_file_names, pool.imap(parse_state_file, state_file_names)
+                ):
+                    self.add_state_rows(rows, source=state_file_name)
+
+    def add_state_rows(self, rows, source=None):
+        # written TABLE_BATCH_ROWS at a time; a duplicate of a row already
+        # written replaces it through the unique id index
+        for rtype, r in rows:
+            self._flush_bulk()
+            if source is not None and self.track_sources:
+                self.pending_resources.append((source, rtype, r["id"]))
+            # dedupe: keep whichever row has more non-NULL values
+            self.resource_types.add(rtype)
+            known = self._completeness(rtype)
+            data_count = sum(1 for _ in filter(lambda x: x is not None, r.values()))
+            if r["id"] in known:
+                if data_count < known[r["id"]]:
+                    continue
+                self._drop_pending(rtype, r["id"])
+            known[r["id"]] = data_count
 
             self._add(rtype, r)
 
     def add_dict_of_tables(self, d_of_t):
-        for t_name, t_rows in d_of_t.items():
-            for r in t_rows:
+        self.add_table_rows(
+            (t_name, r) for t_name, t_rows in d_of_t.items() for r in t_rows
+        )
+
+    def add_table_rows(self, table_rows):
+        # (table, row) pairs, written TABLE_BATCH_ROWS at a time with each
+        # table's columns settled once per batch
+        with self.bulk():
+            for t_name, r in table_rows:
                 self._add(t_name, r)
+                self._flush_bulk()
+
+    def _flush_bulk(self):
+        # once a bulk load has buffered a batch, write it, so it never holds
+        # more than one
+        if self.pending_rows >= TABLE_BATCH_ROWS:
+            with self.lock:
+                self.flush()
+
+    def add_json_file(self, filename):
+        with open(filename, "r") as f:
+            self.add_table_rows(json_table_rows(f))
+
+    def add_yaml_file(self, filename):
+        with open(filename, "r") as f:
+            self.add_table_rows(yaml_table_rows(f))
 
     def add_flowsummary_file(self, flowcache_filename):
-        for row in flowcache_rows(flowcache_filename):
-            self._add("flow", row)
+        with self.bulk():
+            for row in flowcache_rows(flowcache_filename):
+                self._add("flow", row)
 
     def add_database_file(self, filename, database_name):
-        self.db.execute(f"attach database ? as {database_name};", (filename,))
+        # ATTACH fails inside a transaction, so not while a background load
+        # is part way through a flush
+        with self.lock:
+            self.db.execute(f"attach database ? as {database_name};", (filename,))
+            self.generation += 1
+
+    def _add_input(self, kind, filename):
+        self.source = filename if self.track_sources else None
+        try:
+            if kind == "json":
+                self.add_json_file(filename)
+            elif kind == "yaml":
+                self.add_yaml_file(filename)
+            elif kind == "flowsummary":
+                self.add_flowsummary_file(filename)
+            else:
+                raise Exception(f"unknown input kind {kind}")
+        finally:
+            self.source = None
+
+    def refresh(self, inputs, jobs=1):
+        # inputs is a list of (kind, filename); only rows which came from
+        # changed or removed files are deleted and reloaded
+        assert self.bulk_enabled
+        self.track_sources = True
+        self._exec(
+            "create table if not exists tf_files (path primary key, size, mtime, sha256);"
+        )
+        self._exec("create table if not exists tf_resources (path, tbl_name, id);")
+        self._exec(
+            "create index if not exists tf_resources__path on tf_resources (path);"
+        )
+        self._exec(
+            "create table if not exists tf_rowids (path, tbl_name, first_rowid, last_rowid);"
+        )
+        known = {}
+        for path, size, mtime, sha256 in self.db.execute("select * from tf_files;"):
+            known[path] = (size, mtime, sha256)
+        changed = {}
+        for kind, path in inputs:
+            st = os.stat(path)
+            if known.get(path, (None, None))[:2] == (st.st_size, st.st_mtime):
+                continue
+            digest = file_digest(path)
+            if path in known and known[path][2] == digest:
+                self._exec(
+                    "update tf_files set size=?, mtime=? where path=?;",
+                    (st.st_size, st.st_mtime, path),
+                )
+                continue
+            changed[path] = (st.st_size, st.st_mtime, digest)
+        paths = set(path for _, path in inputs)
+        stale = [path for path in known if path in changed or path not in paths]
+        if len(changed) == 0 and len(stale) == 0:
+            return False
+
+        changed_states = [p for kind, p in inputs if kind == "state" and p in changed]
+        if len(known) == 0:  # nothing to merge with, plain load
+            with self.bulk():
+                self.add_state_files(changed_states, jobs)
+                for kind, path in inputs:
+                    if kind != "state":
+                        self._add_input(kind, path)
+                for path in changed:
+                    self.db.execute(
+                        "insert into tf_files values (?,?,?,?);",
+                        (path,) + changed[path],
+                    )
+            return True
+
+        # new contents of changed state files, parsed up front so their ids
+        # take part in choosing which resources to re-dedupe
+        parsed = {}
+        if jobs == 1:
+            for p in changed_states:
+                parsed[p] = parse_state_file(p)
+        else:
+            from multiprocessing import Pool
+
+            with Pool(jobs) as pool:
+                parsed = dict(
+                    zip(changed_states, pool.imap(parse_state_file, changed_states))
+                )
+        affected = set()
+        for rows in parsed.values():
+            affected.update((rtype, r["id"]) for rtype, r in rows)
+
+        with self.bulk():
+            for path in stale:
+                for tbl_name, id in self.db.execute(
+                    "select tbl_name, id from tf_resources where path=?;", (path,)
+                ).fetchall():
+                    affected.add((tbl_name, id))
+                for tbl_name, first, last in self.db.execute(
+                    "select tbl_name, first_rowid, last_rowid from tf_rowids where path=?;",
+                    (path,),
+                ).fetchall():
+                    self.db.execute(
+                        f"delete from {tbl_name} where rowid between ? and ?;",
+                        (first, last),
+                    )
+                    self.changed_tables.add(tbl_name)
+                for tbl in ["tf_resources", "tf_rowids", "tf_files"]:
+                    self.db.execute(f"delete from {tbl} where path=?;", (path,))
+            for tbl_name, id in affected:
+                if tbl_name in self.types:
+                    self.db.execute(f"delete from {tbl_name} where id=?;", (id,))
+                    self._delete_child_rows(tbl_name, [(id,)])
+                    self.changed_tables.add(tbl_name)
+                self._completeness(tbl_name).pop(id, None)
+
+            # every candidate row for an affected id is offered again in
+            # input order, so dedupe ends up as it would on a full load
+            refill = set()
+            for path, tbl_name, id in self.db.execute("select * from tf_resources;"):
+                if (tbl_name, id) in affected:
+                    refill.add(path)
+            for kind, path in inputs:
+                if path in changed:
+                    if kind == "state":
+                        self.add_state_rows(parsed.pop(path), source=path)
+                    else:
+                        self._add_input(kind, path)
+                    self.db.execute(
+                        "insert into tf_files values (?,?,?,?);",
+                        (path,) + changed[path],
+                    )
+                elif path in refill:
+                    self.add_state_rows(
+                        (rtype, r)
+                        for rtype, r in state_file_name_rows(path)
+                        if (rtype, r["id"]) in affected
+                    )
+        return True
+
+    def save_snapshot(self, filename):
+        snapshot = sqlite3.connect(filename + ".tmp")
+        self.db.backup(snapshot)
+        snapshot.close()
+        os.replace(filename + ".tmp", filename)
+
+
+def file_digest(filename):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def open_snapshot(filename):
+    # restore a saved snapshot into an in-memory database
+    db = sqlite3.connect(":memory:", check_same_thread=False)
+    if os.path.exists(filename):
+        snapshot = sqlite3.connect(filename)
+        snapshot.backup(db)
+        snapshot.close()
+    return db
@@ -0,0 +1,61 @@
+import functools
+import json
+import re
+
+
+def flatten_attributes(attributes):
+    # terraform 0.11 style flatmap ("tags.%", "ebs_block_device.0.volume_size")
+    # to one column per top level key, nested values as JSON.  Lists are
+    # created by their ".#" count, which sorts before the elements ('#' < '0');
+    # maps keep their "%" count.
+    flat = {}
+    dotted = []
+    for k, v in attributes.items():
+        if "." in k:
+            dotted.append(k)
+        else:
+            flat[k] = v
+    dotted.sort()  # terraform writes keys sorted, so this is a linear pass
+
+    root = [{}]
+    for k in dotted:
+        v = attributes[k]
+        parts = k.split(".")
+        last = len(parts) - 1
+        parent, key = root, 0
+        for idx, x in enumerate(parts):
+            node = parent[key]
+            if x == "#":
+                assert node is None
+                assert idx == last
+                parent[key] = [None] * int(v)
+                break
+            if node is None:
+                # then host not an array, so must be hash time
+                node = parent[key] = {}
+            if type(node) == dict:
+                if x not in node:
+                    node[x] = None
+                parent, key = node, x
+            elif type(node) == list:
+                parent, key = node, int(x)
+            else:
+                assert False
+        else:
+            parent[key] = v
+
+    for k, v in root[0].items():
+        flat[k] = json.dumps(v)
+    return flat
+
+
+@functools.lru_cache(maxsize=4096)
+def column_name(k):
+    return re.sub(r"[^0-9a-zA-Z]", "_", k).lower()
+
+
+def resource_row(attributes):
+    r = {}
+    for k, v in flatten_attributes(attributes).items():
+        r[column_name(k)] = v
+    return r
@@ -0,0 +1,210 @@
+import re
+import threading
+import time
+from tfdb import flowcache_rows, parse_state_file, state_file_name_rows
+from tfstream import json_table_rows, yaml_table_rows
+
+RESOURCE_TYPE_RE = re.compile(rb'"type":\s*"([A-Za-z0-9_]+)"')
+NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+SCAN_BLOCK_SIZE = 1 << 20  # state file bytes scanned for types at a time
+SCAN_OVERLAP = 4096
+# built from every table by after_load, so only ready once everything is
+DERIVED_TABLES = {"schema", "tf_indexes", "cidr_index", "ip_owner"}
+
+
+def input_tables(kind, filename):
+    # the tables an input can add rows to, None when that can't be known
+    # without loading it; for state files a scan for "type" keys, which may
+    # find a few names that aren't resource types
+    if kind == "state":
+        tables = set()
+        tail = b""
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(SCAN_BLOCK_SIZE), b""):
+                # a match cut short at the end of one block is found whole
+                # in the next
+                buf = tail + block
+                tables.update(m.decode().lower() for m in RESOURCE_TYPE_RE.findall(buf))
+                tail = buf[-SCAN_OVERLAP:]
+        return tables
+    elif kind == "flowsummary":
+        return {"flow"}
+    return None
+
+
+def file_rows(table_rows, filename):
+    # (table, row) pairs of a file, read as they're wanted
+    with open(filename, "r") as f:
+        yield from table_rows(f)
+
+
+def input_rows(kind, filename):
+    if kind == "state":
+        return state_file_name_rows(filename)
+    elif kind == "json":
+        return file_rows(json_table_rows, filename)
+    elif kind == "yaml":
+        return file_rows(yaml_table_rows, filename)
+    elif kind == "flowsummary":
+        return (("flow", row) for row in flowcache_rows(filename))
+    raise Exception(f"unknown input kind {kind}")
+
+
+class BackgroundLoader:
+    # loads (kind, filename) inputs on a thread while the REPL runs; a query
+    # only waits for the tables it names, and inputs holding a table someone
+    # is waiting for are loaded first
+    def __init__(self, tfs, inputs, jobs=1):
+        self.tfs = tfs
+        self.inputs = inputs
+        self.jobs = jobs
+        self.condition = threading.Condition()
+        self.tables = dict()
+        self.pending = dict()
+        self.files = dict()
+        self.unknown = 0
+        self.waiting = set()
+        self.scanned = False
+        self.done = False
+        self.error = None
+        self.start_time = time.time()
+        self.load_time = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._scan()
+            with self.tfs.bulk():
+                self._load_all()
+        except Exception as e:
+            self.error = e
+            import pprint
+
+            pprint.pprint(("loading failed", e))
+        with self.condition:
+            self.done = True
+            self.load_time = time.time() - self.start_time
+            self.condition.notify_all()
+
+    def _scan(self):
+        for idx, (kind, filename) in enumerate(self.inputs):
+            tables = input_tables(kind, filename)
+            with self.condition:
+                self.tables[idx] = tables
+                if tables is None:
+                    self.unknown += 1
+                    continue
+                for tbl_name in tables:
+                    self.pending[tbl_name] = self.pending.get(tbl_name, 0) + 1
+                    self.files[tbl_name] = self.files.get(tbl_name, 0) + 1
+        with self.condition:
+            self.scanned = True
+            self.condition.notify_all()
+
+    def _load_all(self):
+        # json and yaml first: until they're in, any name could be theirs
+        remaining = [idx for idx in self.tables if self.tables[idx] is None]
+        remaining += [idx for idx in self.tables if self.tables[idx] is not None]
+        state_files = [idx for idx in remaining if self.inputs[idx][0] == "state"]
+        if self.jobs != 1 and len(state_files) > 1:
+            # workers parse in input order, so no jumping the queue
+            for idx in remaining:
+                if idx not in state_files:
+                    self._load(idx, input_rows(*self.inputs[idx]))
+            from multiprocessing import Pool
+
+            with Pool(self.jobs) as pool:
+                names = [self.inputs[idx][1] for idx in state_files]
+                for idx, rows in zip(state_files, pool.imap(parse_state_file, names)):
+                    self._load(idx, rows)
+            return
+        while len(remaining) > 0:
+            idx = self._next(remaining)
+            remaining.remove(idx)
+            self._load(idx, input_rows(*self.inputs[idx]))
+
+    def _next(self, remaining):
+        with self.condition:
+            for idx in remaining:
+                if self.tables[idx] is not None and self.tables[idx] & self.waiting:
+                    return idx
+        return remaining[0]
+
+    def _load(self, idx, rows):
+        kind, filename = self.inputs[idx]
+        # streamed, so read as it's added; the lock is taken for each batch
+        # written
+        if kind == "state":
+            self.tfs.add_state_rows(rows, source=filename)
+        else:
+            self.tfs.add_table_rows(rows)
+        with self.tfs.lock:
+            self.tfs.flush()
+        with self.condition:
+            if self.tables[idx] is None:
+                self.unknown -= 1
+            else:
+                for tbl_name in self.tables[idx]:
+                    self.pending[tbl_name] -= 1
+            self.condition.notify_all()
+
+    def _ready(self, name):
+        if self.done:
+            return True
+        if not self.scanned or self.unknown > 0 or name in DERIVED_TABLES:
+            return False
+        # child tables come with their resource type
+        return self.pending.get(name.split("__")[0], 0) == 0
+
+    def wait_for(self, sql):
+        # block until every table the statement might name is loaded
+        names = set(NAME_RE.findall(sql.lower()))
+        with self.condition:
+            blocked = sorted(name for name in names if not self._ready(name))
+            if len(blocked) == 0:
+                return
+            tables = [
+                name
+                for name in blocked
+                if name.split("__")[0] in self.pending or name in DERIVED_TABLES
+            ]
+            print(f"waiting for {', '.join(tables) or 'inputs to be read'}...")
+            bases = {name.split("__")[0] for name in blocked}
+            self.waiting.update(bases)
+            try:
+                self.condition.wait_for(lambda: all(map(self._ready, blocked)))
+            finally:
+                self.waiting.difference_update(bases)
+
+    def status(self):
+        # (table, files loaded, files, rows, state) per table
+        with self.tfs.lock:
+            counts = {
+                tbl_name: self.tfs.db.execute(
+                    f"select count(*) from {tbl_name};"
+                ).fetchone()[0]
+                for tbl_name in self.tfs.types
+            }
+        rows = []
+        with self.condition:
+            for tbl_name in sorted(set(counts) | set(self.files)):
+                state = "ready" if self._ready(tbl_name) else "loading"
+                if tbl_name.split("__")[0] in self.waiting:
+                    state = "waiting"
+                files_loaded = None
+                if tbl_name in self.files:
+                    files_loaded = self.files[tbl_name] - self.pending[tbl_name]
+                rows.append(
+                    (
+                        tbl_name,
+                        files_loaded,
+                        self.files.get(tbl_name),
+                        counts.get(tbl_name, 0),
+                        state,
+                    )
+                )
+        return rows
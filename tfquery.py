@@ -0,0 +1,512 @@
+import collections
+import contextlib
+import json
+import sqlite3
+import sys
+import time
+from tfdb import register_functions
+
+PAGE_SIZE = 1000
+
+
+def field_names(description):
+    # column names, with _1, _2... added to repeats
+    fields = []
+    for i in map(lambda z: z[0], description):
+        if i not in fields:
+            fields.append(i)
+        else:
+            for j in range(1, 20):
+                f_n = f"{i}_{j}"
+                if f_n not in fields:
+                    fields.append(f_n)
+                    break
+    return fields
+
+
+def pages(cur):
+    for rows in iter(lambda: cur.fetchmany(PAGE_SIZE), []):
+        yield rows
+
+
+def non_null_columns(pages_, width):
+    # for #collapse: which of width columns have a value in any row
+    not_nones = [False] * width
+    for rows in pages_:
+        for i in range(0, len(not_nones)):
+            if not not_nones[i]:
+                not_nones[i] = any(row[i] is not None for row in rows)
+    return [i for i, not_none in enumerate(not_nones) if not_none]
+
+
+def query_plan(db, sql):
+    # EXPLAIN QUERY PLAN as an indented tree
+    depth = {0: -1}
+    lines = []
+    for id, parent, _, detail in db.execute(f"explain query plan {sql}"):
+        depth[id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[id] + detail)
+    return lines
+
+
+class Profile:
+    # counts calls and time per SQL function, and VM instructions through a
+    # progress handler called every step_size instructions
+    def __init__(self, step_size=1000):
+        self.step_size = step_size
+        self.steps = 0
+        self.calls = dict()
+        self.times = dict()
+
+    def wrap(self, name, fn):
+        self.calls[name] = 0
+        self.times[name] = 0.0
+
+        def profiled(*args):
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.times[name] += time.perf_counter() - start
+                self.calls[name] += 1
+
+        return profiled
+
+    def progress(self):
+        self.steps += self.step_size
+        return 0
+
+    @contextlib.contextmanager
+    def attach(self, db):
+        register_functions(db, self.wrap)
+        db.set_progress_handler(self.progress, self.step_size)
+        try:
+            yield self
+        finally:
+            db.set_progress_handler(None, 0)
+            register_functions(db)
+
+    def report(self):
+        # (function, calls, seconds) for each function called
+        return [
+            (name, self.calls[name], self.times[name])
+            for name in sorted(self.calls, key=lambda name: -self.times[name])
+            if self.calls[name] > 0
+        ]
+
+
+def normalize_sql(sql):
+    # lower case and single spaces outside quotes, without the trailing ;
+    out = []
+    quote = None
+    space = False
+    for c in sql:
+        if quote is not None:
+            if c == quote:
+                quote = None
+            out.append(c)
+            continue
+        if c.isspace():
+            space = True
+            continue
+        if space and len(out) > 0:
+            out.append(" ")
+        space = False
+        if c in "'\"`[":
+            quote = "]" if c == "[" else c
+        out.append(c.lower())
+    return "".join(out).rstrip(";").rstrip()
+
+
+WRITE_KEYWORDS = {"insert", "update", "delete", "replace", "create", "drop", "alter"}
+
+
+def is_read_only(sql):
+    words = normalize_sql(sql).split(" ")
+    if words[0] in ("select", "values"):
+        return True
+    return words[0] == "with" and not (WRITE_KEYWORDS & set(words))
+
+
+def row_size(row):
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+
+
+class ResultCache:
+    # LRU of (description, rows) of read only queries, keyed on the
+    # normalized SQL and TerraformState.generation, up to max_bytes of rows
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.too_big = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, description, rows, size):
+        # anything from an older generation can never be hit again
+        for old in [old for old in self.entries if old[1] != key[1]]:
+            self._drop(old)
+        self.entries[key] = (description, rows, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        self.bytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return [
+            ("entries", len(self.entries)),
+            ("bytes", self.bytes),
+            ("max bytes", self.max_bytes),
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("too big to cache", self.too_big),
+        ]
+
+
+def cached_pages(cache, key, description, pages_):
+    # pass pages through, keeping the rows for the cache until they
+    # outgrow it
+    rows = []
+    size = 0
+    for page in pages_:
+        if rows is not None:
+            rows += page
+            size += sum(map(row_size, page))
+            if size > cache.max_bytes:
+                cache.too_big += 1
+                rows = None
+        yield page
+    if rows is not None:
+        cache.put(key, description, rows, size)
+
+
+def output_path(flags):
+    for flag in flags:
+        if flag.startswith("out="):
+            return flag[4:]
+    return None
+
+
+@contextlib.contextmanager
+def output(flags):
+    path = output_path(flags)
+    if path is None:
+        yield sys.stdout
+        return
+    with open(path, "w", newline="") as f:
+        yield f
+
+
+def write_results(db, sql, flags, cache=None, generation=0):
+    # run sql and write its rows a page at a time, as a table (#md for
+    # markdown), #csv or #jsonl, to stdout or #out=path; returns the row
+    # count.  Read only queries are answered from cache when it's given,
+    # unless #nocache
+    key = None
+    cached = None
+    if cache is not None and "nocache" not in flags and is_read_only(sql):
+        key = (normalize_sql(sql), generation)
+        cached = cache.get(key)
+    columns = None
+    if cached is not None:
+        description, rows = cached[:2]
+        result = [rows[i : i + PAGE_SIZE] for i in range(0, len(rows), PAGE_SIZE)]
+        if "collapse" in flags:
+            columns = non_null_columns(result, len(description))
+    else:
+        cur = db.execute(sql)
+        description = cur.description
+        if description is None:
+            return 0
+        result = pages(cur)
+        if "collapse" in flags:
+            # hide all columns which are only NULL: a read only query is run
+            # again after the scan rather than held in memory, anything else
+            # only runs once
+            if is_read_only(sql):
+                columns = non_null_columns(result, len(description))
+                result = pages(db.execute(sql))
+            else:
+                result = list(result)
+                columns = non_null_columns(result, len(description))
+        if key is not None:
+            result = cached_pages(cache, key, description, result)
+    fields = field_names(description)
+    if columns is not None:
+        fields = [fields[i] for i in columns]
+        result = project_pages(result, columns)
+    count = 0
+    widths = None
+    bottom = None
+    with output(flags) as f:
+        if "csv" in flags:
+            import csv
+
+            writer = csv.writer(f)
+            writer.writerow(fields)
+        for rows in result:
+            count += len(rows)
+            if "no-format" in flags:
+                for i in rows:
+                    print(i[0], file=f)
+            elif "csv" in flags:
+                writer.writerows(rows)
+            elif "jsonl" in flags:
+                for row in rows:
+                    print(json.dumps(dict(zip(fields, row)), default=str), file=f)
+            else:
+                # one table sized by its first page, the heading once and the
+                # rows of every page under it; a page with wider values
+                # closes it and starts another (markdown doesn't need the
+                # columns lined up), rather than running the query again to
+                # size the first
+                page_widths = column_widths(fields, [rows])
+                if widths is None or (
+                    "md" not in flags and any(map(int.__gt__, page_widths, widths))
+                ):
+                    if bottom is not None:
+                        print(bottom, file=f)
+                    if widths is not None:
+                        page_widths = list(map(max, widths, page_widths))
+                    widths = page_widths
+                    table = page_table(fields, rows, flags, widths)
+                    lines = table.get_string().splitlines()
+                    if "md" not in flags:
+                        bottom = lines.pop()
+                else:
+                    table = page_table(fields, rows, flags, widths)
+                    lines = table.get_string(header=False).splitlines()
+                    if "md" not in flags:
+                        lines = lines[1:-1]
+                print("\n".join(lines), file=f)
+        if bottom is not None:
+            print(bottom, file=f)
+        if count == 0 and not ({"no-format", "csv", "jsonl"} & flags):
+            print(page_table(fields, [], flags), file=f)
+    return count
+
+
+def project_pages(pages_, columns):
+    for rows in pages_:
+        yield [[row[i] for i in columns] for row in rows]
+
+
+def column_widths(fields, pages_):
+    # the printed width of each column's widest value
+    widths = [len(field) for field in fields]
+    for rows in pages_:
+        for row in rows:
+            for i, v in enumerate(row):
+                widths[i] = max(widths[i], *map(len, str(v).split("\n")))
+    return widths
+
+
+def page_table(fields, rows, flags, widths=None):
+    # a PrettyTable of a page of rows, its columns at least widths wide
+    import prettytable
+
+    table = prettytable.PrettyTable()
+    table.field_names = fields
+    table.add_rows(rows)
+    table.align = "l"
+    if "md" in flags:
+        table.set_style(prettytable.MARKDOWN)
+    if widths is not None:
+        for field, width in zip(fields, widths):
+            table.min_width[field] = width
+    return table
+
+
+def loop_sql(qtext, columns, data_table):
+    # one query over the whole data table: the template runs once per
+    # distinct set of parameters, each ? becoming a reference to the value
+    # it was bound from, and is joined back to the data rows.  None when the
+    # template can't be rewritten (numbered or named parameters, ? count
+    # mismatch)
+    out = []
+    n = 0
+    quote = None
+    for idx, c in enumerate(qtext):
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in "'\"`[":
+            quote = "]" if c == "[" else c
+        elif c == "?":
+            if n == len(columns) or qtext[idx + 1 : idx + 2].isdigit():
+                return None
+            out.append(f"tf_loop_params.p{n}")
+            n += 1
+            continue
+        elif c in ":@$":
+            return None
+        out.append(c)
+    if n != len(columns):
+        return None
+    inner = "".join(out).strip().rstrip(";")
+    if n == 0:
+        return f"select ({inner}) from {data_table} order by rowid;"
+    params = ",".join(f'"{col}" as p{p}' for p, col in enumerate(columns))
+    joins = " and ".join(
+        f'tf_loop_results.p{p} is tf_loop_data."{col}"' for p, col in enumerate(columns)
+    )
+    # materialized, so the template isn't pulled back into the outer scan
+    return f"""with tf_loop_results as materialized
+            (select *, ({inner}) as v from
+            (select distinct {params} from {data_table}) as tf_loop_params)
+        select tf_loop_results.v from {data_table} as tf_loop_data
+        left join tf_loop_results on {joins}
+        order by tf_loop_data.rowid;"""
+
+
+def has_rowid(db, tbl_name):
+    try:
+        db.execute(f"select rowid from {tbl_name} limit 0;")
+    except sqlite3.Error:
+        return False
+    return True
+
+
+def loop_results(db, qtext, columns, data_table):
+    # per data row results of one template, set based where possible; every
+    # template has to walk the data in the same (rowid) order
+    sql = loop_sql(qtext, columns, data_table)
+    if sql is not None and has_rowid(db, data_table):
+        try:
+            cur = db.execute(sql)
+        except sqlite3.Error:
+            pass
+        else:
+            return "set", (row[0] for rows in pages(cur) for row in rows)
+    return "per-row", per_row_results(db, qtext, columns, data_table)
+
+
+def data_order(db, tbl_name):
+    return " order by rowid" if has_rowid(db, tbl_name) else ""
+
+
+def per_row_results(db, qtext, columns, data_table):
+    # the template run once per distinct set of parameters; sqlite3 keeps
+    # the prepared statement between calls
+    data = db.execute(f"select * from {data_table}{data_order(db, data_table)};")
+    colmap = {i[0]: idx for idx, i in enumerate(data.description)}
+    cur = db.cursor()
+    cache = {}
+    for rows in pages(data):
+        for row in rows:
+            params = tuple(row[colmap[col]] for col in columns)
+            if params not in cache:
+                cur.execute(qtext, params)
+                result = cur.fetchone()
+                if result is not None:
+                    result = result[0]
+                cache[params] = result
+            yield cache[params]
+
+
+def timed(results, timings, idx):
+    while True:
+        start = time.time()
+        try:
+            result = next(results)
+        except StopIteration:
+            return
+        finally:
+            timings[idx] += time.time() - start
+        yield result
+
+
+def loop_queries(db, query_table, data_table, flags):
+    # .loop: every query in query_table (columns q and p0..p9, naming the
+    # data_table columns bound to its ? parameters) for every data_table
+    # row, one comma separated line per row; returns (query, how, seconds)
+    queries = []
+    cur = db.execute(f"select * from {query_table};")
+    colmap = {i[0]: idx for idx, i in enumerate(cur.description)}
+    for row in cur.fetchall():
+        columns = []
+        for p in range(0, 10):
+            p_k = f"p{p}"
+            if p_k in colmap and row[colmap[p_k]] is not None:
+                columns.append(row[colmap[p_k]])
+        queries.append((row[colmap["q"]], columns))
+    timings = [0.0] * len(queries)
+    hows = []
+    streams = []
+    for idx, (qtext, columns) in enumerate(queries):
+        start = time.time()
+        how, results = loop_results(db, qtext, columns, data_table)
+        timings[idx] += time.time() - start
+        hows.append(how)
+        streams.append(timed(results, timings, idx))
+    with output(flags) as f:
+        if len(streams) == 0:
+            (count,) = db.execute(f"select count(*) from {data_table};").fetchone()
+            for _ in range(0, count):
+                print("", file=f)
+        for results in zip(*streams):
+            print(",".join(map(str, results)), file=f)
+    return [
+        (qtext, how, timing) for (qtext, _), how, timing in zip(queries, hows, timings)
+    ]
+
+
+def script_statements(text):
+    # the statements in a --script file: SQL (with any #flags) up to a ';',
+    # or a single line .metacommand; blank and -- comment lines between
+    # statements are skipped
+    statement = ""
+    for line in text.splitlines():
+        if statement == "":
+            if line.strip() == "" or line.lstrip().startswith("--"):
+                continue
+            if line.startswith("."):
+                yield line
+                continue
+        statement += line + "\n"
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+    if statement.strip() != "":
+        yield statement.strip()
+
+
+def run_query(job):
+    # --parallel worker: one statement on its own read-only connection;
+    # returns (sql, output path, rows, seconds, error)
+    import pathlib
+
+    snapshot, flowdb, sql, flags = job
+    db = sqlite3.connect(
+        pathlib.Path(snapshot).absolute().as_uri() + "?mode=ro", uri=True
+    )
+    register_functions(db)
+    if flowdb is not None:
+        # the snapshot is of the main database only
+        db.execute(
+            "attach database ? as flowdb;",
+            (pathlib.Path(flowdb).absolute().as_uri() + "?mode=ro",),
+        )
+    start = time.time()
+    try:
+        rows = write_results(db, sql, flags)
+    except (sqlite3.Error, OSError) as e:
+        return sql, output_path(flags), None, time.time() - start, str(e)
+    finally:
+        db.close()
+    return sql, output_path(flags), rows, time.time() - start, None
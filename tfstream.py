@@ -0,0 +1,254 @@
+import json
+import re
+
+from tfflat import column_name, resource_row
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JSONStream:
+    # walks a JSON document a value at a time, so only the value being
+    # decoded has to be held in memory
+    def __init__(self, f, block_size=1 << 16):
+        self.f = f
+        self.block_size = block_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size):
+        block = self.f.read(size)
+        if len(block) == 0:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos :] + block
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read(self.block_size):
+                return ""
+
+    def expect(self, c):
+        found = self.peek()
+        if found != c:
+            raise json.JSONDecodeError(f"expected {c!r}", self.buf, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        size = self.block_size
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer might carry on
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return v
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read(size)
+            size *= 2
+
+    def _members(self, start, end):
+        self.expect(start)
+        if self.peek() == end:
+            self.pos += 1
+            return
+        while True:
+            yield
+            c = self.peek()
+            self.pos += 1
+            if c == end:
+                return
+            if c != ",":
+                raise json.JSONDecodeError("expected ','", self.buf, self.pos - 1)
+
+    def keys(self):
+        # yields each key of an object; the caller must consume its value
+        for _ in self._members("{", "}"):
+            key = self.value()
+            self.expect(":")
+            yield key
+
+    def elements(self):
+        # yields once per array element; the caller must consume it
+        yield from self._members("[", "]")
+
+
+def nested_resource_row(attributes):
+    # terraform 0.12+ state has typed, nested attributes; store them the way
+    # the flatmap ones are
+    r = {}
+    for k, v in attributes.items():
+        if isinstance(v, (dict, list)):
+            v = json.dumps(v)
+        elif isinstance(v, bool):
+            v = "true" if v else "false"
+        elif isinstance(v, (int, float)):
+            v = str(v)
+        r[column_name(k)] = v
+    return r
+
+
+def instance_row(instance):
+    if "attributes" in instance:
+        return nested_resource_row(instance["attributes"])
+    return resource_row(instance["attributes_flat"])
+
+
+def state_resources(state_file):
+    # (rtype, row) for every resource in a version 3 (modules[0].resources)
+    # or version 4 (resources[].instances[]) state file
+    stream = JSONStream(state_file)
+    for key in stream.keys():
+        if key == "modules":
+            modules = 0
+            for _ in stream.elements():
+                modules += 1
+                assert modules == 1
+                for module_key in stream.keys():
+                    if module_key != "resources":
+                        stream.value()
+                        continue
+                    for name in stream.keys():
+                        resource = stream.value()
+                        yield resource["type"], resource_row(
+                            resource["primary"]["attributes"]
+                        )
+        elif key == "resources":
+            for _ in stream.elements():
+                rtype = None
+                instances = []  # only if "instances" comes before "type"
+                for resource_key in stream.keys():
+                    if resource_key == "type":
+                        rtype = stream.value()
+                    elif resource_key == "instances" and rtype is not None:
+                        for _ in stream.elements():
+                            yield rtype, instance_row(stream.value())
+                    elif resource_key == "instances":
+                        instances = stream.value()
+                    else:
+                        stream.value()
+                for instance in instances:
+                    yield rtype, instance_row(instance)
+        else:
+            stream.value()
+
+
+def json_table_rows(f):
+    # (table, row) for a {"table": [row, ...], ...} document, a row at a time
+    stream = JSONStream(f)
+    for t_name in stream.keys():
+        for _ in stream.elements():
+            yield t_name, stream.value()
+
+
+class YAMLRows:
+    # builds values straight from parser events, so a {table: [row, ...]}
+    # document can be read a row at a time; libyaml's parser when installed
+    def __init__(self, f):
+        import yaml
+
+        self.yaml = yaml
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        self.loader = loader(f)
+        self.anchors = dict()
+
+    def check(self, event_class):
+        return self.loader.check_event(event_class)
+
+    def value(self):
+        yaml = self.yaml
+        event = self.loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            return self.anchors[event.anchor]
+        if isinstance(event, yaml.ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == "!":
+                tag = self.loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+            node = yaml.ScalarNode(tag, event.value, style=event.style)
+            constructor = self.loader.yaml_constructors.get(tag)
+            if constructor is None:
+                constructor = self.loader.yaml_constructors[None]
+            v = constructor(self.loader, node)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            v = []
+            while not self.check(yaml.SequenceEndEvent):
+                v.append(self.value())
+            self.loader.get_event()
+        elif isinstance(event, yaml.MappingStartEvent):
+            v = {}
+            merged = {}
+            while not self.check(yaml.MappingEndEvent):
+                if self.merge_key():
+                    self.loader.get_event()
+                    merged.update(self.merge_value())
+                    continue
+                k = self.value()
+                v[k] = self.value()
+            self.loader.get_event()
+            if len(merged) > 0:
+                # as SafeConstructor.flatten_mapping: merged keys first, the
+                # mapping's own keys taking precedence
+                merged.update(v)
+                v = merged
+        else:
+            raise Exception(f"unexpected yaml {event}")
+        if event.anchor is not None:
+            self.anchors[event.anchor] = v
+        return v
+
+    def merge_key(self):
+        # is the next event a << key
+        yaml = self.yaml
+        event = self.loader.peek_event()
+        if not isinstance(event, yaml.ScalarEvent):
+            return False
+        tag = event.tag
+        if tag is None or tag == "!":
+            tag = self.loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        return tag == "tag:yaml.org,2002:merge"
+
+    def merge_value(self):
+        # a mapping, or a list of them with the earlier ones taking precedence
+        value = self.value()
+        mappings = value if isinstance(value, list) else [value]
+        merged = {}
+        for mapping in mappings:
+            if not isinstance(mapping, dict):
+                raise Exception(f"yaml << expects a mapping, not {mapping!r}")
+            for k, v in mapping.items():
+                merged.setdefault(k, v)
+        return merged
+
+    def table_rows(self):
+        yaml = self.yaml
+        try:
+            self.loader.get_event()  # stream start
+            if self.check(yaml.StreamEndEvent):
+                return
+            self.loader.get_event()  # document start
+            if not self.check(yaml.MappingStartEvent):
+                raise Exception("yaml input should be a mapping of tables")
+            self.loader.get_event()
+            while not self.check(yaml.MappingEndEvent):
+                t_name = self.value()
+                if not self.check(yaml.SequenceStartEvent):
+                    raise Exception(f"yaml table {t_name} should be a list of rows")
+                self.loader.get_event()
+                while not self.check(yaml.SequenceEndEvent):
+                    yield t_name, self.value()
+                self.loader.get_event()
+        finally:
+            self.loader.dispose()
+
+
+def yaml_table_rows(f):
+    return YAMLRows(f).table_rows()